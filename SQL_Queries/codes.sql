@@ -1,6 +1,7 @@
 SELECT
     i.icustay_id, d.subject_id, d.hadm_id,
-    array_agg(d.icd9_code ORDER BY seq_num ASC) AS icd9_codes
+    array_agg(d.icd9_code ORDER BY seq_num ASC) AS icd9_codes,
+    array_agg(c.ccs_matched_id ORDER BY seq_num ASC) AS ccs_codes
 FROM diagnoses_icd d 
     LEFT OUTER JOIN (SELECT ccs_matched_id, icd9_code from ccs_dx) c
     ON c.icd9_code = d.icd9_code
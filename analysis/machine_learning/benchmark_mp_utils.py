@@ -0,0 +1,243 @@
+# compare the feature extraction functions in mp_utils against the fast versions on synthetic data
+# usage: python benchmark_mp_utils.py [n_stays] [n_hours]
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+import mp_utils
+
+
+class _ItemsList(dict):
+    # get_design_matrix calls np.asarray(time_dict.items()), which needs a list of pairs (as in python 2)
+    def items(self):
+        return list(dict.items(self))
+
+
+def make_synthetic_hourly(n_stays=2000, n_hours=96, missing_rate=0.7, seed=0):
+    # hourly data shaped like the input of get_design_matrix: icustay_id, hr and every variable
+    # in vars_of_interest(), with some hours before ICU admission and a few repeated hours
+    rng = np.random.RandomState(seed)
+    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = mp_utils.vars_of_interest()
+    variables = sorted(set(var_min + var_max + var_first + var_last + var_sum + var_first_early + var_last_early))
+
+    lengths = rng.randint(1, n_hours, size=n_stays)
+    icustay_id = np.repeat(200001 + np.arange(n_stays), lengths)
+    hr = np.concatenate([np.sort(rng.randint(-24, l + 1, size=l)) for l in lengths])
+
+    df = pd.DataFrame({'icustay_id': icustay_id, 'hr': hr})
+    values = rng.randn(len(df), len(variables)) * 10 + 50
+    values[rng.rand(len(df), len(variables)) < missing_rate] = np.nan
+    df = pd.concat([df, pd.DataFrame(values, columns=variables)], axis=1)
+
+    time_dict = dict(zip(200001 + np.arange(n_stays), rng.randint(0, n_hours, size=n_stays)))
+    return df, time_dict
+
+
+def add_missing_variables(df, var_lists, missing_rate=0.7, seed=2):
+    # columns for the variables of var_lists that df doesn't have (e.g. those only in vars_of_interest_streaming)
+    rng = np.random.RandomState(seed)
+    df = df.copy()
+    for x in sorted(set(x for v in var_lists if v for x in v) - set(df.columns)):
+        df[x] = np.where(rng.rand(len(df)) < missing_rate, np.nan, rng.randn(len(df)) * 10 + 50)
+    return df
+
+
+def replay_streaming(df_iid, W, W_extra, var_lists, times):
+    # StreamingFeatureState over the rows of one stay in hourly order, with the features after every hour in times
+    state = mp_utils.StreamingFeatureState(W=W, W_extra=W_extra, var_lists=var_lists)
+    df_iid = df_iid.sort_values('hr', kind='mergesort')
+    hr, rows = df_iid['hr'].values, df_iid.to_dict('records')
+    i, X = 0, list()
+    for t in times:
+        while i < len(rows) and hr[i] <= t:
+            state.update(hr[i], rows[i])
+            i += 1
+        X.append(state.features(t))
+    return state.columns, X
+
+
+class _SumModel(object):
+    # stands in for a fitted classifier in get_predictions
+    def predict_proba(self, X):
+        p = 1.0 / (1.0 + np.exp(-np.nansum(X, axis=1) / 1000.0))
+        return np.column_stack([1 - p, p])
+
+
+def make_synthetic_csvs(path, n_stays=20000, n_features=400, seed=0):
+    # icustays_offset.csv and design_matrix.csv as read by load_design_matrix, and the matching co frame
+    rng = np.random.RandomState(seed)
+    icustay_id = 200001 + np.arange(n_stays)
+    intime = pd.Timestamp('2100-01-01') + pd.to_timedelta(rng.randint(0, 10**8, size=n_stays), 's')
+    deathtime = pd.Series(intime + pd.to_timedelta(rng.randint(0, 10**6, size=n_stays), 's'))
+    deathtime[rng.rand(n_stays) < 0.8] = pd.NaT
+    pd.DataFrame({'icustay_id': icustay_id, 'intime': intime,
+                  'outtime': intime + pd.to_timedelta(rng.randint(10**4, 10**6, size=n_stays), 's'),
+                  'starttime': rng.randint(0, 10**5, size=n_stays), 'deathtime': deathtime}).to_csv(
+        os.path.join(path, 'icustays_offset.csv'), index=False)
+
+    columns = ['f{:03d}'.format(i) for i in range(n_features)] + mp_utils.DESIGN_MATRIX_VARS_TO_DELETE
+    df_design = pd.DataFrame(rng.randn(n_stays, len(columns)), columns=columns)
+    df_design.insert(0, 'icustay_id', icustay_id)
+    df_design.to_csv(os.path.join(path, 'design_matrix.csv'), index=False)
+
+    co = pd.DataFrame({'hospital_expire_flag': rng.randint(0, 2, size=n_stays)}, index=icustay_id)
+    return co
+
+
+def make_synthetic_tables(n_stays=2000, n_hours=96, seed=0):
+    # point tables (keyed by icustay_id and an integer charttime_elapsed, in hours) and range tables
+    # (one row per interval) shaped like the input of collapse_data, with intervals that cover hours
+    # where no point table has a row
+    rng = np.random.RandomState(seed)
+    data = dict()
+    for name, columns in [('vitals', ['heartrate', 'sysbp']), ('labs', ['lactate', 'heartrate'])]:
+        n = n_stays * n_hours // 8
+        df = pd.DataFrame({'icustay_id': 200001 + rng.randint(0, n_stays, size=n),
+                           'charttime_elapsed': rng.randint(0, n_hours, size=n)})
+        for c in columns:
+            df[c] = rng.randn(n)
+        data[name] = df
+    for name in ['vent', 'vasopressor', 'rrt_range']:
+        n = n_stays // 2
+        start = rng.randint(0, n_hours, size=n) + rng.rand(n) * (rng.rand(n) < 0.5)
+        data[name] = pd.DataFrame({'icustay_id': 200001 + rng.randint(0, n_stays, size=n), 'starttime_elapsed': start,
+                                   'endtime_elapsed': start + rng.randint(0, 24, size=n)})
+    return data
+
+
+def collapse_data_reference(data):
+    # collapse_data_fast, one interval and one hour at a time
+    keys = ['icustay_id', 'charttime_elapsed']
+    flags = {'vent': 'vent', 'vasopressor': 'vasopressor', 'rrt_range': 'rrt'}
+    rows = set()
+    for f, df in data.items():
+        if f not in flags:
+            rows.update(zip(df['icustay_id'], df['charttime_elapsed']))
+    covered = dict((f, set()) for f in flags)
+    for f in flags:
+        for iid, start, end in data[f][['icustay_id', 'starttime_elapsed', 'endtime_elapsed']].values:
+            for hr in range(int(np.ceil(start)), int(np.floor(end)) + 1):
+                covered[f].add((int(iid), hr))
+            rows.update(covered[f])
+    ref = pd.DataFrame(sorted(rows), columns=keys)
+    for f in flags:
+        intervals = data[f]
+        ref[flags[f]] = [int(((intervals['icustay_id'] == iid) & (intervals['starttime_elapsed'] <= hr) &
+                              (intervals['endtime_elapsed'] >= hr)).any()) for iid, hr in ref[keys].values]
+    return ref
+
+
+def time_it(fn, *args, **kwargs):
+    start = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - start
+
+
+if __name__ == '__main__':
+    n_stays = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_hours = int(sys.argv[2]) if len(sys.argv) > 2 else 96
+
+    df, time_dict = make_synthetic_hourly(n_stays, n_hours)
+    print('Synthetic data: {} rows x {} columns, {} stays.'.format(df.shape[0], df.shape[1], n_stays))
+
+    for W, W_extra in [(8, 24), (4, 24)]:
+        X_ref, t_ref = time_it(mp_utils.get_design_matrix, df, _ItemsList(time_dict), W=W, W_extra=W_extra)
+        # pandas may append stays that only have early rows after the others, rather than sorting them
+        X_ref = X_ref.sort_index()
+        X_fast, t_fast = time_it(mp_utils.get_design_matrix_fast, df, time_dict, W=W, W_extra=W_extra)
+
+        print('W={}, W_extra={}'.format(W, W_extra))
+        print('  get_design_matrix:      {:.3f} sec'.format(t_ref))
+        print('  get_design_matrix_fast: {:.3f} sec ({:.1f}x)'.format(t_fast, t_ref / t_fast))
+
+        assert list(X_fast.columns) == list(X_ref.columns)
+        assert (X_fast.index.values == X_ref.index.values).all()
+        np.testing.assert_allclose(X_fast.values, X_ref.values.astype(float))
+    print('Outputs match.')
+
+    # replaying the rows of a stay in hourly order through StreamingFeatureState, against get_design_matrix_fast
+    # at every hour, through the hours after the last row where the windows empty out
+    iids = sorted(time_dict.keys())[:20]
+    for var_lists in [mp_utils.vars_of_interest()[:7], mp_utils.vars_of_interest_streaming()]:
+        df_stream = add_missing_variables(df, var_lists)
+        for W, W_extra in [(8, 24), (4, 24)]:
+            t_ref, t_stream, n_hours_scored = 0.0, 0.0, 0
+            for iid in iids:
+                df_iid = df_stream.loc[df_stream['icustay_id'] == iid, :]
+                times = np.arange(df_iid['hr'].min(), df_iid['hr'].max() + W + W_extra + 2)
+                (columns, X), elapsed = time_it(replay_streaming, df_iid, W, W_extra, var_lists, times)
+                t_stream += elapsed
+                for t, x in zip(times, X):
+                    X_ref, elapsed = time_it(mp_utils.get_design_matrix_fast, df_iid, {iid: t}, W=W, W_extra=W_extra,
+                                             var_lists=var_lists)
+                    t_ref += elapsed
+                    assert list(X_ref.columns) == columns
+                    # get_design_matrix_fast drops stays without rows in the window; the stream gives all NaN
+                    x_ref = X_ref.values[0] if len(X_ref) else np.full(len(columns), np.nan)
+                    np.testing.assert_allclose(x, x_ref, err_msg='icustay_id {}, hr {}'.format(iid, t))
+                n_hours_scored += len(times)
+            print('Streaming {} hours of {} stays, {} variables, W={}, W_extra={}'.format(
+                n_hours_scored, len(iids), len(columns), W, W_extra))
+            print('  get_design_matrix_fast per hour: {:.3f} sec'.format(t_ref))
+            print('  StreamingFeatureState:           {:.3f} sec ({:.1f}x)'.format(t_stream, t_ref / t_stream))
+    print('Streaming features match.')
+
+    # scoring every hour of a few stays, one get_design_matrix call per hour vs. one batched call
+    var_static = mp_utils.vars_of_interest()[7]
+    df_static = pd.DataFrame(np.random.RandomState(1).rand(n_stays, len(var_static)), columns=var_static)
+    df_static.insert(0, 'icustay_id', 200001 + np.arange(n_stays))
+    iids = sorted(time_dict.keys())[:20]
+    df = df.drop_duplicates(['icustay_id', 'hr'])
+
+    start = time.time()
+    prob_ref = list()
+    for iid in iids:
+        df_iid = df.loc[df['icustay_id'] == iid, :]
+        for t in df_iid['hr'].values:
+            X = mp_utils.get_design_matrix(df_iid, _ItemsList({iid: t}), W=4, W_extra=24)
+            X = X.merge(df_static.set_index('icustay_id')[var_static], how='left', left_index=True, right_index=True)
+            prob_ref.append(_SumModel().predict_proba(X.values)[0, 1])
+    t_ref = time.time() - start
+
+    df_pred, t_batch = time_it(mp_utils.get_predictions_batch, df, df_static, _SumModel(), icustay_ids=iids)
+    print('Scoring {} hours of {} stays'.format(len(prob_ref), len(iids)))
+    print('  get_design_matrix per hour: {:.3f} sec'.format(t_ref))
+    print('  get_predictions_batch:      {:.3f} sec ({:.1f}x)'.format(t_batch, t_ref / t_batch))
+    np.testing.assert_allclose(df_pred['prob'].values, prob_ref)
+    print('Predictions match.')
+
+    # loading the design matrix from csv, and from the column cache once it exists
+    path = tempfile.mkdtemp() + os.sep
+    co = make_synthetic_csvs(path, n_stays=n_stays * 10)
+    cache_formats = ['parquet', 'npy'] if mp_utils._parquet_available() else ['npy']
+    for diedWithin in [None, 48 * 3600]:
+        (X_ref, y_ref, header_ref), t_ref = time_it(mp_utils.load_design_matrix, co, path=path, diedWithin=diedWithin)
+        print('load_design_matrix, diedWithin={}, {} x {}'.format(diedWithin, X_ref.shape[0], X_ref.shape[1]))
+        print('  load_design_matrix:                        {:.3f} sec'.format(t_ref))
+        for cache_format in cache_formats:
+            kwargs = {'path': path, 'diedWithin': diedWithin, 'cache_format': cache_format,
+                      'cache_dir': os.path.join(path, 'cache_' + cache_format)}
+            _, t_cold = time_it(mp_utils.load_design_matrix_fast, co, **kwargs)
+            (X, y, header), t_warm = time_it(mp_utils.load_design_matrix_fast, co, **kwargs)
+            print('  load_design_matrix_fast ({}, cold):   {:.3f} sec'.format(cache_format.ljust(7), t_cold))
+            print('  load_design_matrix_fast ({}, cached): {:.3f} sec ({:.1f}x)'.format(
+                cache_format.ljust(7), t_warm, t_ref / t_warm))
+            assert header == header_ref and X.dtype == np.float32 and y.dtype == np.float32
+            np.testing.assert_allclose(X, X_ref.astype(np.float32))
+            np.testing.assert_array_equal(y, y_ref.astype(np.float32))
+    print('Design matrices match.')
+
+    # joining the hourly tables, with the hours each interval covers
+    data = make_synthetic_tables(n_stays // 20, n_hours)
+    ref, t_ref = time_it(collapse_data_reference, data)
+    df, t_fast = time_it(mp_utils.collapse_data_fast, data)
+    print('collapse_data, {} rows'.format(len(df)))
+    print('  per interval and hour: {:.3f} sec'.format(t_ref))
+    print('  collapse_data_fast:    {:.3f} sec ({:.1f}x)'.format(t_fast, t_ref / t_fast))
+    assert (df[['icustay_id', 'charttime_elapsed']].values == ref[['icustay_id', 'charttime_elapsed']].values).all()
+    for c in ['vent', 'vasopressor', 'rrt']:
+        assert (df[c].values == ref[c].values).all(), c
+    print('Interval rows and flags match.')
@@ -1,23 +1,229 @@
 # Import libraries
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
 import pandas as pd
 import psycopg2
+import psycopg2.pool
 
 
 # information used to create a database connection
-sqluser = 'postgres'
-dbname = 'mimic4'
-hostname = 'localhost'
-port_number = 5434
+# each can be overridden with an environment variable, or with configureConnection()
+sqluser = os.environ.get('MIMIC_DB_USER', 'postgres')
+dbname = os.environ.get('MIMIC_DB_NAME', 'mimic4')
+hostname = os.environ.get('MIMIC_DB_HOST', 'localhost')
+port_number = int(os.environ.get('MIMIC_DB_PORT', 5434))
+password = os.environ.get('MIMIC_DB_PASSWORD', 'mysecretpassword')
 schema_name = 'mimiciv'
 
-# Connect to postgres with a copy of the MIMIC-III database
-con = psycopg2.connect(dbname=dbname, user=sqluser, host=hostname, port=port_number, password='mysecretpassword')
+# bounds on the number of pooled connections: up to pool_maxconn are open at once, and up to pool_minconn
+# are kept open between queries
+pool_minconn = int(os.environ.get('MIMIC_DB_POOL_MIN', 1))
+pool_maxconn = int(os.environ.get('MIMIC_DB_POOL_MAX', 8))
 
 # the below statement is prepended to queries to ensure they select from the right schema
 query_schema = 'set search_path to ' + schema_name + ';'
 
+# on-disk cache of query results (see runQuery): disabled unless a directory is set here, through
+# MIMIC_QUERY_CACHE_DIR or with configureCache(). entries older than cache_ttl seconds are ignored, and the
+# least recently used entries are removed when the cache is larger than cache_max_bytes.
+cache_dir = os.environ.get('MIMIC_QUERY_CACHE_DIR', None)
+cache_ttl = float(os.environ.get('MIMIC_QUERY_CACHE_TTL', 7 * 24 * 3600))
+cache_max_bytes = int(float(os.environ.get('MIMIC_QUERY_CACHE_MAX_MB', 2048)) * 1024 ** 2)
 
-def getStaticFeatures():
+# connections to postgres with a copy of the MIMIC-IV database are only opened when first needed
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_con = None
+
+
+def configureConnection(dbname=None, user=None, host=None, port=None, password=None, minconn=None, maxconn=None):
+    # change the connection settings; the pool (and the connection behind con) are recreated on next use
+    global sqluser, hostname, port_number, pool_minconn, pool_maxconn
+    # dbname and password are also argument names, so those globals are set through globals()
+    settings = globals()
+    if dbname is not None:
+        settings['dbname'] = dbname
+    if user is not None:
+        sqluser = user
+    if host is not None:
+        hostname = host
+    if port is not None:
+        port_number = port
+    if password is not None:
+        settings['password'] = password
+    if minconn is not None:
+        pool_minconn = minconn
+    if maxconn is not None:
+        pool_maxconn = maxconn
+    closeConnections()
+
+
+def getPool():
+    # the shared, thread-safe connection pool, created on first use
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(pool_minconn, pool_maxconn, dbname=dbname, user=sqluser,
+                                                         host=hostname, port=port_number, password=password)
+            # the pool raises rather than waits when all connections are in use, so borrowers wait on this
+            _pool_slots = threading.BoundedSemaphore(pool_maxconn)
+        return _pool
+
+
+def closeConnections():
+    global _pool, _pool_slots, _con
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool, _pool_slots = None, None
+        if _con is not None:
+            _con.close()
+            _con = None
+
+
+class PooledQuerier(object):
+    # runs each query on a connection borrowed from the pool, so parallel feature jobs share a bounded
+    # number of connections; pass an instance (or a psycopg2 connection) as the querier of the get* functions
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def query(self, query):
+        if self.pool is not None:
+            pool, slots = self.pool, None
+        else:
+            pool = getPool()
+            slots = _pool_slots
+        if slots is not None:
+            slots.acquire()
+        try:
+            connection = pool.getconn()
+            try:
+                return pd.read_sql_query(query, connection)
+            finally:
+                pool.putconn(connection)
+        finally:
+            if slots is not None:
+                slots.release()
+
+
+def configureCache(path=None, ttl=None, max_bytes=None):
+    global cache_dir, cache_ttl, cache_max_bytes
+    if path is not None:
+        cache_dir = path
+    if ttl is not None:
+        cache_ttl = ttl
+    if max_bytes is not None:
+        cache_max_bytes = max_bytes
+
+
+def _parquetAvailable():
+    try:
+        import pyarrow
+    except ImportError:
+        try:
+            import fastparquet
+        except ImportError:
+            return False
+    return True
+
+
+def _databaseId(querier):
+    # identifies the database a querier reads from, or None if unknown (and the result is not cached)
+    if querier is None or (isinstance(querier, PooledQuerier) and querier.pool is None):
+        return '{}@{}:{}/{}'.format(sqluser, hostname, port_number, dbname)
+    if hasattr(querier, 'db_id'):
+        return querier.db_id
+    if hasattr(querier, 'info') and hasattr(querier.info, 'dsn_parameters'):
+        dsn = querier.info.dsn_parameters
+        return '{}@{}:{}/{}'.format(dsn.get('user'), dsn.get('host'), dsn.get('port'), dsn.get('dbname'))
+    return None
+
+
+def _cacheFile(name, args, query, querier):
+    db_id = _databaseId(querier)
+    if cache_dir is None or name is None or db_id is None or not _parquetAvailable():
+        return None
+    key = json.dumps([name, [repr(a) for a in args], hashlib.sha1(query.encode('utf-8')).hexdigest(), db_id])
+    return os.path.join(cache_dir, name + '-' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.parquet')
+
+
+def _evictCache():
+    # remove the least recently used entries (by access time, updated on every hit) until the cache fits
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.parquet'):
+            stat = os.stat(os.path.join(cache_dir, f))
+            entries.append((stat.st_atime, stat.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries):
+        if total <= cache_max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, f))
+        except OSError:
+            pass
+        total -= size
+
+
+def clearCache():
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        if f.endswith('.parquet'):
+            os.remove(os.path.join(cache_dir, f))
+
+
+def runQuery(query, querier=None, name=None, args=()):
+    # querier: None (use the pool), an object with a query(sql) method, or a database connection
+    # with name (the calling function) and args, results are cached on disk as parquet, keyed by
+    # (name, args, hash of the sql, database) - see cache_dir. without pyarrow or fastparquet, nothing is cached.
+    cache_file = _cacheFile(name, args, query, querier)
+    if cache_file is not None and os.path.exists(cache_file):
+        modified = os.path.getmtime(cache_file)
+        if time.time() - modified <= cache_ttl:
+            try:
+                result = pd.read_parquet(cache_file)
+                os.utime(cache_file, (time.time(), modified))
+                return result
+            except (IOError, OSError, ValueError):
+                pass
+
+    if querier is None:
+        querier = PooledQuerier()
+    if hasattr(querier, 'query'):
+        result = querier.query(query)
+    else:
+        result = pd.read_sql_query(query, querier)
+
+    if cache_file is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write under a temporary name first, so readers never see a partial file
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        result.to_parquet(tmp_file)
+        os.replace(tmp_file, cache_file)
+        _evictCache()
+    return result
+
+
+def __getattr__(name):
+    # the module-level connection "con" of earlier versions, now opened on first access
+    global _con
+    if name == 'con':
+        with _pool_lock:
+            if _con is None or _con.closed:
+                _con = psycopg2.connect(dbname=dbname, user=sqluser, host=hostname, port=port_number,
+                                        password=password)
+            return _con
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def getStaticFeatures(querier=None):
     query = query_schema + \
     """
     WITH ht AS
@@ -118,11 +324,11 @@ def getStaticFeatures():
     ON ie.stay_id = wt.stay_id AND wt.rn = 1
     """
 
-    static = pd.read_sql_query(query, con)
+    static = runQuery(query, querier, 'getStaticFeatures')
     return static
 
 
-def getLabFeatures(mode='first', duration=24, pre_admission_lookback=8):
+def getLabFeatures(mode='first', duration=24, pre_admission_lookback=8, querier=None):
     query = query_schema + \
     """
     WITH labs_preceeding AS
@@ -281,12 +487,12 @@ def getLabFeatures(mode='first', duration=24, pre_admission_lookback=8):
     ON icu.stay_id = lg.stay_id
     """
 
-    lab = pd.read_sql_query(query, con)
+    lab = runQuery(query, querier, 'getLabFeatures', (mode, duration, pre_admission_lookback))
 
     return lab
 
 
-def getVitalsFeatures(mode='first', duration=24):
+def getVitalsFeatures(mode='first', duration=24, querier=None):
     query = query_schema + \
     """
     WITH vitals_stg_1 AS
@@ -365,12 +571,12 @@ def getVitalsFeatures(mode='first', duration=24):
     SELECT * FROM vitals_stg_3
     """
 
-    first_vitals = pd.read_sql_query(query, con)
+    first_vitals = runQuery(query, querier, 'getVitalsFeatures', (mode, duration))
 
     return first_vitals
 
 
-def getMinMaxVitalsFeatures(mode='min', duration=24):
+def getMinMaxVitalsFeatures(mode='min', duration=24, querier=None):
     query = query_schema + \
     """
     WITH vitals_stg_1 AS
@@ -466,12 +672,12 @@ def getMinMaxVitalsFeatures(mode='min', duration=24):
     SELECT * FROM vitals_stg_4
     """
 
-    vitals = pd.read_sql_query(query, con)
+    vitals = runQuery(query, querier, 'getMinMaxVitalsFeatures', (mode, duration))
 
     return vitals
 
 
-def getInhospitalMortality():
+def getInhospitalMortality(querier=None):
     query = query_schema + \
     """
     SELECT
@@ -482,12 +688,12 @@ def getInhospitalMortality():
     ON adm.hadm_id = icu.hadm_id
     """
 
-    mortality = pd.read_sql_query(query, con)
+    mortality = runQuery(query, querier, 'getInhospitalMortality')
 
     return mortality
 
 
-def getFilteredCohort(duration=24):
+def getFilteredCohort(duration=24, querier=None):
     query = query_schema + \
     """
     SELECT
@@ -505,8 +711,199 @@ def getFilteredCohort(duration=24):
     AND (FLOOR(DATE_PART('day', adm.admittime - make_timestamp(pat.anchor_year, 1, 1, 0, 0, 0))/365.0) + pat.anchor_age) > 18
     """
 
-    filtered = pd.read_sql_query(query, con)
+    filtered = runQuery(query, querier, 'getFilteredCohort', (duration,))
 
     return filtered
 
 
+
+
+# (column name prefix, label, itemids) of the labs and vitals used by the get*Features functions
+lab_items = [
+    ('bun', 'BUN', [51006]),
+    ('chloride', 'CHLORIDE', [50806, 50902]),
+    ('creatinine', 'CREATININE', [50912]),
+    ('hgb', 'HEMOGLOBIN', [50811, 51222]),
+    ('platelet', 'PLATELET', [51265]),
+    ('potassium', 'POTASSIUM', [50822, 50971]),
+    ('sodium', 'SODIUM', [50824, 50983]),
+    ('tco2', 'TOTALCO2', [50804]),
+    ('wbc', 'WBC', [51300, 51301]),
+    ('bg_po2', 'PO2', [50821, 52042, 50832]),
+    ('bg_pco2', 'PCO2', [50818, 52040, 50830]),
+    ('bg_ph', 'PH', [50820, 52041, 50831]),
+    ('bg_baseexcess', 'BASEEXCESS', [50802, 52038]),
+    ('bg_carboxyhemoglobin', 'CARBOXYHEMOGLOBIN', [50805]),
+    ('bg_methemomoglobin', 'METHEMOGLOBIN', [50814]),
+    ('aniongap', 'ANIONGAP', [50868, 52500]),
+    ('albumin', 'ALBUMIN', [50862]),
+    ('bands', 'BANDS', [51144]),
+    ('bicarbonate', 'BICARBONATE', [50803, 50882]),
+    ('bilrubin', 'BILRUBIN', [50885]),
+    ('glucose', 'GLUCOSE', [51478, 50931]),
+    ('hematocrit', 'HEMATOCRIT', [51221]),
+    ('lactate', 'LACTATE', [50813]),
+    ('ptt', 'PTT', [51275]),
+    ('inr', 'INR', [51237]),
+]
+
+vital_items = [
+    ('heartrate', 'HEARTRATE', [220045]),
+    ('sysbp', 'SYSBP', [220050, 220179]),
+    ('diabp', 'DIASBP', [220051, 220180]),
+    ('meanbp', 'MEANBP', [220052, 220181, 225312]),
+    ('resprate', 'RESPRATE', [220210, 224688, 224689, 224690]),
+    ('tempc', 'TEMPC', [223761, 223762]),
+    ('spo2', 'SPO2', [220277]),
+    ('gcseye', 'GCSEYE', [220739]),
+    ('gcsverbal', 'GCSVERBAL', [223900]),
+    ('gcsmotor', 'GCSMOTOR', [223901]),
+]
+
+
+def _labelCase(items, column='itemid'):
+    return 'CASE\n' + '\n'.join(
+        "            WHEN " + column + " IN (" + ', '.join(str(i) for i in itemids) + ") THEN '" + label + "'"
+        for name, label, itemids in items
+    ) + '\n          ELSE null\n        END'
+
+
+def _aggregateColumns(items, modes, durations):
+    # one aggregate per (item, mode, duration), each restricted to its duration with a FILTER clause
+    # first/last take the earliest/latest value by charttime, as in getLabFeatures and getVitalsFeatures
+    # returns the select list and the column names
+    columns, aliases = [], []
+    for d in durations:
+        for mode in modes:
+            for name, label, itemids in items:
+                condition = "label = '" + label + "' AND hr <= " + str(d)
+                if mode in ('first', 'last'):
+                    agg = '(ARRAY_AGG(valuenum ORDER BY charttime' + (' DESC' if mode == 'last' else ' ASC') + \
+                          ') FILTER (WHERE ' + condition + '))[1]'
+                else:
+                    agg = mode.upper() + '(valuenum) FILTER (WHERE ' + condition + ')'
+                alias = name + '_' + mode + ('_' + str(d) + 'h' if len(durations) > 1 else '')
+                columns.append(agg + ' AS ' + alias)
+                aliases.append(alias)
+    return '\n        , '.join(columns), aliases
+
+
+def getCombinedFeatures(durations=(24,), lab_modes=('first', 'last', 'min', 'max'),
+                        vital_modes=('first', 'last', 'min', 'max'), pre_admission_lookback=8, querier=None):
+    # labs and vitals for every (mode, duration) in one query: labevents and chartevents are each scanned once,
+    # over the longest duration, and every feature is an aggregate with a FILTER on its own duration
+    # returns one row per icu stay (NaN where a stay has no values), with the column names of getLabFeatures
+    # and getVitalsFeatures/getMinMaxVitalsFeatures, e.g. bun_first; with more than one duration, the duration
+    # is appended, e.g. bun_first_24h
+    durations = sorted(set(durations))
+    max_duration = str(max(durations))
+
+    lab_columns, lab_aliases = _aggregateColumns(lab_items, lab_modes, durations)
+    vital_columns, vital_aliases = _aggregateColumns(vital_items, vital_modes, durations)
+    lab_itemids = ', '.join(str(i) for name, label, itemids in lab_items for i in itemids)
+    vital_itemids = ', '.join(str(i) for name, label, itemids in vital_items for i in itemids)
+
+    query = query_schema + \
+    """
+    WITH labs AS
+    (
+        SELECT icu.stay_id, l.valuenum, l.charttime
+        , EXTRACT(EPOCH FROM l.charttime - icu.intime) / 3600.0 AS hr
+        , """ + _labelCase(lab_items, 'l.itemid') + """ AS label
+        FROM mimiciv.icustays icu
+        INNER JOIN mimiciv.labevents l
+        ON l.hadm_id = icu.hadm_id
+        AND l.charttime >= icu.intime - interval '""" + str(pre_admission_lookback) + """ hour'
+        AND l.charttime <= icu.intime + interval '""" + max_duration + """ hour'
+        WHERE l.itemid IN (""" + lab_itemids + """)
+        AND l.valuenum IS NOT null
+    )
+    , labs_agg AS
+    (
+        SELECT stay_id
+        , """ + lab_columns + """
+        FROM labs
+        GROUP BY stay_id
+    )
+    , vitals AS
+    (
+        SELECT icu.stay_id, cev.charttime
+        , CASE
+                WHEN cev.itemid = 223761 THEN (cev.valuenum-32)/1.8
+            ELSE cev.valuenum
+        END AS valuenum
+        , EXTRACT(EPOCH FROM cev.charttime - icu.intime) / 3600.0 AS hr
+        , """ + _labelCase(vital_items, 'cev.itemid') + """ AS label
+        FROM mimiciv.icustays icu
+        INNER JOIN mimiciv.chartevents cev
+        ON cev.stay_id = icu.stay_id
+        AND cev.charttime >= icu.intime
+        AND cev.charttime <= icu.intime + interval '""" + max_duration + """ hour'
+        WHERE cev.itemid IN (""" + vital_itemids + """)
+        AND cev.valuenum IS NOT null
+    )
+    , vitals_agg AS
+    (
+        SELECT stay_id
+        , """ + vital_columns + """
+        FROM vitals
+        GROUP BY stay_id
+    )
+    SELECT icu.stay_id
+    """ + ''.join('\n    , la.' + a for a in lab_aliases) + ''.join('\n    , va.' + a for a in vital_aliases) + """
+    FROM mimiciv.icustays icu
+    LEFT JOIN labs_agg la
+    ON icu.stay_id = la.stay_id
+    LEFT JOIN vitals_agg va
+    ON icu.stay_id = va.stay_id
+    """
+
+    combined = runQuery(query, querier, 'getCombinedFeatures',
+                        (durations, lab_modes, vital_modes, pre_admission_lookback))
+
+    return combined
+
+
+def getFeatureTable(duration=24, pre_admission_lookback=8, max_workers=None, querier=None, how='inner', verbose=True):
+    # the feature table of the feature engineering notebooks: cohort, static, first/last labs, first/last vitals,
+    # max/min/avg vitals and mortality, joined on stay_id
+    # the queries are independent, so they run concurrently on a thread pool, each on its own pooled
+    # connection (up to pool_maxconn at once); the table is ready in about the time of the slowest query
+    # returns the table and the seconds each query took
+    jobs = [
+        ('filtered', getFilteredCohort, dict(duration=duration)),
+        ('static', getStaticFeatures, dict()),
+        ('first_lab', getLabFeatures, dict(mode='first', duration=duration, pre_admission_lookback=pre_admission_lookback)),
+        ('last_lab', getLabFeatures, dict(mode='last', duration=duration, pre_admission_lookback=pre_admission_lookback)),
+        ('first_vitals', getVitalsFeatures, dict(mode='first', duration=duration)),
+        ('last_vitals', getVitalsFeatures, dict(mode='last', duration=duration)),
+        ('max_vitals', getMinMaxVitalsFeatures, dict(mode='max', duration=duration)),
+        ('min_vitals', getMinMaxVitalsFeatures, dict(mode='min', duration=duration)),
+        ('avg_vitals', getMinMaxVitalsFeatures, dict(mode='avg', duration=duration)),
+        ('mortality', getInhospitalMortality, dict()),
+    ]
+
+    def timed(fn, kwargs):
+        start = time.time()
+        result = fn(querier=querier, **kwargs)
+        return result, time.time() - start
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as executor:
+        futures = [(name, executor.submit(timed, fn, kwargs)) for name, fn, kwargs in jobs]
+        results, latencies = {}, {}
+        for name, future in futures:
+            results[name], latencies[name] = future.result()
+    total = time.time() - start
+
+    data = results[jobs[0][0]]
+    for name, fn, kwargs in jobs[1:]:
+        data = pd.merge(data, results[name], on=['stay_id'], how=how)
+
+    if verbose:
+        for name, fn, kwargs in jobs:
+            print('{:15s} {:8.2f}s'.format(name, latencies[name]))
+        print('{:15s} {:8.2f}s (sum of queries {:.2f}s)'.format('total', total, sum(latencies.values())))
+
+    return data, latencies
+
@@ -2,8 +2,11 @@
 import numpy as np
 import pandas as pd
 import psycopg2
+import os
+import json
 import sys
 import datetime as dt
+from collections import deque
 from sklearn import metrics
 import matplotlib.pyplot as plt
 
@@ -116,6 +119,55 @@ def generate_times_before_death(df, T=None, T_to_death=None, seed=None):
     windowtime_dict = df.set_index('icustay_id')['windowtime'].to_dict()
     return windowtime_dict
 
+def sample_window_times(df, n_samples=1, T=None, T_to_death=None, censor=False, rng=None, seed=None):
+    # a vectorized version of generate_times: draws n_samples window times for every stay at once
+    # df is not modified. returns (icustay_id, windowtime), with windowtime of shape [n_stays, n_samples]
+    # rng is a numpy Generator or RandomState; by default np.random.default_rng(seed) (a RandomState
+    # on numpy versions without default_rng), independent of the global numpy random state.
+    # with rng=np.random.RandomState(seed), windowtime[:,0] matches generate_times(df, T, T_to_death, seed, censor)
+    if rng is None:
+        if hasattr(np.random, 'default_rng'):
+            rng = np.random.default_rng(seed)
+        else:
+            rng = np.random.RandomState(seed)
+
+    dischtime = df['dischtime_hours'].values.astype(float)
+    deathtime = df['deathtime_hours'].values.astype(float)
+
+    # the last allowable time for the window: discharge, or death/censoring if earlier
+    with np.errstate(invalid='ignore'):
+        endtime = np.where(deathtime < dischtime, deathtime, dischtime)
+        if censor:
+            censortime = df['censortime_hours'].values.astype(float)
+            endtime = np.where(censortime < endtime, censortime, endtime)
+
+    # one row of draws per sample, so the first sample uses the same draws as generate_times
+    tau = rng.random((n_samples, df.shape[0])) if hasattr(rng, 'random') else rng.rand(n_samples, df.shape[0])
+    tau = tau.T
+
+    if T is not None:
+        windowtime = np.floor(tau * (endtime - T)[:, None])
+        windowtime[windowtime < 0] = 0
+    else:
+        windowtime = np.floor(tau * endtime[:, None])
+
+    if T_to_death is not None:
+        with np.errstate(invalid='ignore'):
+            idxInICU = (deathtime - dischtime) <= T_to_death
+        windowtime[idxInICU, :] = (deathtime[idxInICU] - T_to_death)[:, None]
+
+    return df['icustay_id'].values, windowtime
+
+def get_design_matrix_samples(df, icustay_ids, windowtime, W=8, W_extra=24, var_lists=None):
+    # design matrices for all the window times from sample_window_times, in one call
+    # returns a dataframe with a sample column (the column of windowtime) next to icustay_id and hr
+    windowtime = np.asarray(windowtime)
+    n_stays, n_samples = windowtime.shape
+    X = get_design_matrix_at_times(df, np.tile(icustay_ids, n_samples), windowtime.T.ravel(),
+                                   W=W, W_extra=W_extra, var_lists=var_lists)
+    X.insert(0, 'sample', np.repeat(np.arange(n_samples), n_stays))
+    return X
+
 # pretty confusion matrices!
 def print_cm(y, yhat):
     print('\nConfusion matrix')
@@ -290,6 +342,270 @@ def get_design_matrix(df, time_dict, W=8, W_extra=24):
 
     return df_data
 
+# the functions below compute the same features as get_design_matrix without building the
+# (W+W_extra+1) rows per stay: rows are sorted once by (icustay_id, hr), each window is found
+# with searchsorted, and every aggregation is a segment reduction over the sorted rows
+def _sort_hourly_rows(df):
+    # sorts the rows of df once by (icustay_id, hr) - stable, so ties keep their order in df - and
+    # returns what _window_bounds needs to find windows. like the merge in get_design_matrix, only
+    # integer hours can fall in a window.
+    hr = df['hr'].values.astype(float)
+    keep = np.flatnonzero(~np.isnan(hr) & (np.mod(hr, 1) == 0))
+    ids = df['icustay_id'].values[keep].astype(np.int64)
+    hr = hr[keep].astype(np.int64)
+
+    # hourly data is usually sorted already, which is cheaper to check than to sort again
+    is_sorted = (np.diff(ids) > 0) | ((np.diff(ids) == 0) & (np.diff(hr) >= 0))
+    if not is_sorted.all():
+        order = np.lexsort((hr, ids))
+        keep, ids, hr = keep[order], ids[order], hr[order]
+    is_start = np.ones(len(ids), dtype=bool)
+    is_start[1:] = ids[1:] != ids[:-1]
+    stays, codes = ids[is_start], np.cumsum(is_start) - 1
+
+    # a single sorted key: stay code, then the hour relative to the earliest hour
+    hr_min = hr.min() if len(hr) else 0
+    span = (hr.max() - hr_min + 1) if len(hr) else 1
+    return {'rows': keep, 'stays': stays, 'hr_min': hr_min, 'span': span,
+            'key': codes.astype(np.int64) * span + (hr - hr_min)}
+
+def _window_bounds(sorted_rows, query_ids, query_start, query_end):
+    # for each query, the positions [lo, hi) in the sorted rows with
+    # icustay_id == query_ids and query_start <= hr <= query_end
+    stays, key, span, hr_min = sorted_rows['stays'], sorted_rows['key'], sorted_rows['span'], sorted_rows['hr_min']
+    if len(stays) == 0:
+        empty = np.zeros(len(query_ids), dtype=np.int64)
+        return empty, empty
+
+    pos = np.searchsorted(stays, query_ids)
+    found = (pos < len(stays)) & (stays[np.minimum(pos, len(stays) - 1)] == query_ids)
+    pos = np.where(found, pos, 0).astype(np.int64)
+
+    # clipping keeps each window inside its own stay's range of keys
+    start = np.clip(np.asarray(query_start, dtype=np.int64) - hr_min, 0, span)
+    end = np.clip(np.asarray(query_end, dtype=np.int64) - hr_min, -1, span - 1)
+    lo = np.searchsorted(key, pos * span + start, side='left')
+    hi = np.searchsorted(key, pos * span + end, side='right')
+    hi = np.where(found, np.maximum(hi, lo), lo)
+    return lo.astype(np.int64), hi.astype(np.int64)
+
+def _segment_reduce(V, lo, hi, how):
+    # reduce the columns [lo[k], hi[k]) of V (n_vars x n_rows + 1, so each variable is contiguous), ignoring NaN,
+    # in one reduceat call. returns n_vars x len(lo).
+    # empty segments are NaN; otherwise all-NaN segments are NaN, except for 'sum' which is 0
+    # the last column of V must be a NaN sentinel: it keeps every boundary (including hi == n) a valid index
+    n = V.shape[1] - 1
+    if len(lo) == 0:
+        return np.zeros([V.shape[0], 0])
+
+    # reduceat over the interleaved [lo, hi] boundaries: even outputs are the segments
+    bounds = np.column_stack([lo, hi]).ravel()
+
+    if how in ('first', 'last'):
+        # reduce the positions of non-null values, then look the values up
+        # the sentinel column (position n) stands for "no value"
+        rows = np.arange(n + 1, dtype=np.int64)[None, :]
+        valid = ~np.isnan(V)
+        if how == 'first':
+            idx = np.minimum.reduceat(np.where(valid, rows, n), bounds, axis=1)[:, ::2]
+        else:
+            idx = np.maximum.reduceat(np.where(valid, rows, -1), bounds, axis=1)[:, ::2]
+            idx[idx < 0] = n
+        out = np.take_along_axis(V, idx, axis=1)
+    elif how == 'min':
+        out = np.fmin.reduceat(V, bounds, axis=1)[:, ::2]
+    elif how == 'max':
+        out = np.fmax.reduceat(V, bounds, axis=1)[:, ::2]
+    elif how == 'sum':
+        out = np.add.reduceat(np.nan_to_num(V), bounds, axis=1)[:, ::2]
+    else:
+        raise ValueError('Unknown aggregation: {}'.format(how))
+    return np.where((hi <= lo)[None, :], np.nan, out)
+
+def _design_matrix_rows(df, sorted_rows, query_ids, query_t, W, W_extra, var_lists):
+    # one row of features per (query_ids[k], query_t[k]) pair, with the columns of get_design_matrix
+    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_lists[:7]
+    query_t = np.asarray(query_t).astype(int)
+
+    early_lo, early_hi = _window_bounds(sorted_rows, query_ids, query_t - (W + W_extra), query_t)
+    late_lo, late_hi = _window_bounds(sorted_rows, query_ids, query_t - W, query_t)
+
+    # gather only the rows of each early window from df, so the kernels only touch rows that are used
+    # the late window is the tail of the early window
+    lengths = early_hi - early_lo
+    stop = np.cumsum(lengths)
+    start = stop - lengths
+    rows = sorted_rows['rows'][np.repeat(early_lo - start, lengths) + np.arange(stop[-1] if len(stop) else 0)]
+    windows = {'early': (start, stop), 'late': (start + (late_lo - early_lo), stop)}
+
+    features = [(var_first, 'first', 'late', '_first'),
+                (var_first_early, 'first', 'early', '_first_early'),
+                (var_last, 'last', 'late', '_last'),
+                (var_last_early, 'last', 'early', '_last_early'),
+                (var_min, 'min', 'late', '_min'),
+                (var_max, 'max', 'late', '_max'),
+                (var_sum, 'sum', 'late', '_sum')]
+
+    # most lists are shared between aggregations (e.g. var_first_early and var_last_early), so gather each once
+    X_header, blocks, gathered = list(), list(), dict()
+    for var_list, how, window, suffix in features:
+        if not var_list:
+            continue
+        lo, hi = windows[window]
+        if tuple(var_list) not in gathered:
+            V = np.full([len(var_list), len(rows) + 1], np.nan)
+            for i, v in enumerate(var_list):
+                V[i, :-1] = df[v].values[rows]
+            gathered[tuple(var_list)] = V
+        blocks.append(_segment_reduce(gathered[tuple(var_list)], lo, hi, how))
+        X_header.extend([v + suffix for v in var_list])
+
+    X = np.vstack(blocks).T if blocks else np.zeros([len(query_ids), 0])
+    return X, X_header, lengths > 0
+
+def get_design_matrix_fast(df, time_dict, W=8, W_extra=24, var_lists=None):
+    # same output as get_design_matrix(df, time_dict, W, W_extra), as floats and sorted by icustay_id
+    # within a stay, rows are taken in (hr, order in df) order; get_design_matrix uses the order of df,
+    # which is the same whenever df is sorted by hr
+    # var_lists optionally replaces the first 7 lists returned by vars_of_interest()
+    if var_lists is None:
+        var_lists = vars_of_interest()
+    if isinstance(time_dict, pd.Series):
+        time_dict = time_dict.to_dict()
+    query_ids = np.asarray(list(time_dict.keys()), dtype=np.int64)
+    query_t = np.asarray(list(time_dict.values()), dtype=float)
+    order = np.argsort(query_ids, kind='mergesort')
+    query_ids, query_t = query_ids[order], query_t[order]
+
+    sorted_rows = _sort_hourly_rows(df)
+    X, X_header, has_rows = _design_matrix_rows(df, sorted_rows, query_ids, query_t, W, W_extra, var_lists)
+
+    # like the groupby in get_design_matrix, stays without any rows in the window are dropped
+    df_data = pd.DataFrame(X[has_rows], columns=X_header,
+                           index=pd.Index(query_ids[has_rows], name='icustay_id'))
+    return df_data
+
+def get_design_matrix_at_times(df, icustay_ids, times, W=8, W_extra=24, var_lists=None):
+    # the get_design_matrix features for many (icustay_id, time) pairs in one call, e.g. every hour of a stay
+    # df is sorted once and every window is found in the same sorted rows
+    # returns one row per pair, in the order given, with icustay_id and hr (the window time) as the first
+    # two columns. unlike get_design_matrix, pairs without data in their window are kept, as all NaN.
+    if var_lists is None:
+        var_lists = vars_of_interest()
+    query_ids = np.asarray(icustay_ids, dtype=np.int64)
+    query_t = np.asarray(times, dtype=float)
+
+    sorted_rows = _sort_hourly_rows(df)
+    X, X_header, _ = _design_matrix_rows(df, sorted_rows, query_ids, query_t, W, W_extra, var_lists)
+
+    df_data = pd.DataFrame(X, columns=X_header)
+    df_data.insert(0, 'hr', query_t.astype(int))
+    df_data.insert(0, 'icustay_id', query_ids)
+    return df_data
+
+class StreamingFeatureState(object):
+    # the get_design_matrix features of a single icustay_id, kept up to date as hourly rows arrive
+    # for bedside-style scoring: each update is O(1) amortized per variable, instead of recomputing windows
+    #   state = StreamingFeatureState(W=8, W_extra=24)
+    #   for hr, row in rows_of_one_stay:  # hr must not decrease
+    #       state.update(hr, row)         # row: dict or pd.Series of variable values (missing/NaN allowed)
+    #       x = state.features()          # as get_design_matrix_fast(..., {iid: hr}, var_lists=...), once
+    #                                     # every row of hour hr has been added
+    # windows end at the hour given to features() (by default, the hour of the last row), and as in
+    # get_design_matrix they are [t - W, t] and [t - W - W_extra, t] for the "early" variables.
+    def __init__(self, W=8, W_extra=24, var_lists=None):
+        if var_lists is None:
+            var_lists = vars_of_interest_streaming()
+        var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_lists[:7]
+        self.W, self.W_extra = W, W_extra
+
+        # (variables, aggregation, window, column suffix), in the column order of get_design_matrix
+        self.features_spec = [(list(v), how, window, suffix) for v, how, window, suffix in [
+            (var_first, 'first', 'late', '_first'),
+            (var_first_early, 'first', 'early', '_first_early'),
+            (var_last, 'last', 'late', '_last'),
+            (var_last_early, 'last', 'early', '_last_early'),
+            (var_min, 'min', 'late', '_min'),
+            (var_max, 'max', 'late', '_max'),
+            (var_sum, 'sum', 'late', '_sum')] if v]
+        self.columns = [x + suffix for v, how, window, suffix in self.features_spec for x in v]
+
+        # hours of the rows in each window, to know whether a window has any rows
+        self.hours = {'late': deque(), 'early': deque()}
+        # per (aggregation, window, variable): the non-null (hr, value) pairs still needed
+        #   first: all values in the window, the first is at the front
+        #   last: only the latest value
+        #   min/max: a monotonic deque, the min/max is at the front
+        #   sum: all values in the window, plus the running sum
+        self.values = dict()
+        self.sums = dict()
+        for v, how, window, suffix in self.features_spec:
+            for x in v:
+                self.values[(how, window, x)] = deque()
+                if how == 'sum':
+                    self.sums[x] = 0.0
+        self.last_hr = None
+
+    def update(self, hr, row):
+        # add the values of the row charted at hour hr
+        if self.last_hr is not None and hr < self.last_hr:
+            raise ValueError('Rows must be added in order of hr: got {} after {}.'.format(hr, self.last_hr))
+        self.last_hr = hr
+        self.hours['late'].append(hr)
+        self.hours['early'].append(hr)
+
+        for (how, window, x), q in self.values.items():
+            value = row.get(x, None) if hasattr(row, 'get') else row[x]
+            if value is None or value != value:
+                continue
+            if how == 'last':
+                q.clear()
+            elif how == 'min':
+                while q and q[-1][1] >= value:
+                    q.pop()
+            elif how == 'max':
+                while q and q[-1][1] <= value:
+                    q.pop()
+            elif how == 'sum':
+                self.sums[x] += value
+            q.append((hr, value))
+
+    def _evict(self, t):
+        start = {'late': t - self.W, 'early': t - self.W - self.W_extra}
+        for window, q in self.hours.items():
+            while q and q[0] < start[window]:
+                q.popleft()
+        for (how, window, x), q in self.values.items():
+            while q and q[0][0] < start[window]:
+                hr, value = q.popleft()
+                if how == 'sum':
+                    self.sums[x] -= value
+
+    def features(self, t=None):
+        # the feature vector for a window ending at hour t (>= the hour of the last row), ordered as self.columns
+        # windows only move forward: rows that fall out of the window for t are dropped
+        if t is None:
+            t = self.last_hr
+        if t is None:
+            return np.full(len(self.columns), np.nan)
+        self._evict(t)
+
+        out = list()
+        for v, how, window, suffix in self.features_spec:
+            if not self.hours[window]:
+                out.extend([np.nan] * len(v))
+                continue
+            for x in v:
+                q = self.values[(how, window, x)]
+                if how == 'sum':
+                    # 0 for no values, as with groupby().sum(); the deque is only empty if nothing was added
+                    out.append(self.sums[x] if q else 0.0)
+                elif how == 'last':
+                    out.append(q[-1][1] if q else np.nan)
+                else:
+                    out.append(q[0][1] if q else np.nan)
+        return np.asarray(out, dtype=float)
+
 # this function is used to print out data for a single pt
 # mainly used for debugging weird inconsistencies in data extraction
 # e.g. "wait why does this icustay_id not have heart rate?"
@@ -376,6 +692,105 @@ def collapse_data(data):
         return df
 
 
+def _in_intervals(point_ids, point_times, interval_ids, starts, ends):
+    # for each (point_ids[i], point_times[i]), whether it lies in any [starts[j], ends[j]] with interval_ids[j] == point_ids[i]
+    if len(starts) == 0 or len(point_times) == 0:
+        return np.zeros(len(point_times), dtype=bool)
+    stays = np.unique(np.concatenate([point_ids, interval_ids]))
+    t_min = min(np.nanmin(point_times), np.nanmin(starts))
+    span = max(np.nanmax(point_times), np.nanmax(ends)) - t_min + 1
+
+    # a single sorted key: stay code, then the time relative to the earliest time
+    def key(ids, t):
+        return np.searchsorted(stays, ids) * span + (np.asarray(t, dtype=float) - t_min)
+
+    start_key, end_key = key(interval_ids, starts), key(interval_ids, ends)
+    order = np.argsort(start_key, kind='mergesort')
+    start_key, end_key = start_key[order], end_key[order]
+    # the furthest an interval starting at or before each one reaches: intervals of earlier stays
+    # always end before the keys of later stays, so this never crosses stays
+    end_key = np.maximum.accumulate(np.where(np.isnan(end_key), -np.inf, end_key))
+
+    p = key(point_ids, point_times)
+    j = np.searchsorted(start_key, p, side='right') - 1
+    return (j >= 0) & (end_key[np.maximum(j, 0)] >= p)
+
+def _expand_intervals(ids, starts, ends, step=1):
+    # the times on a grid of step (0, step, 2*step, ...) inside each [starts[j], ends[j]], as (ids, times),
+    # built with one np.repeat over the number of grid times in each interval plus an offset arange
+    starts, ends = np.asarray(starts, dtype=float), np.asarray(ends, dtype=float)
+    valid = ~np.isnan(starts) & ~np.isnan(ends)
+    first = np.ceil(starts[valid] / step) * step
+    n = np.maximum(np.floor((ends[valid] - first) / step).astype(np.int64) + 1, 0)
+
+    offsets = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    return np.repeat(np.asarray(ids)[valid], n), np.repeat(first, n) + offsets * step
+
+def collapse_data_fast(data, range_start='starttime_elapsed', range_end='endtime_elapsed', interval_step=1):
+    # joins a dictionary of dataframes into a single dataframe on icustay_id and charttime_elapsed,
+    # without modifying the input dataframes
+    # each table is indexed by the keys once and all are joined in a single concat; rows with the same
+    # keys within a table are collapsed to their last non-null values
+    # a column appearing in more than one table is suffixed with the table name
+    # the range tables (vent, vasopressor, rrt_range) have one row per interval, [range_start, range_end].
+    # each interval is expanded to a row for every time on a grid of interval_step (hours, by default) that
+    # it covers, so times with no other data still appear; interval_step=None only marks existing rows.
+    # each range table adds a 0/1 column (vent, vasopressor, rrt) which is 1 for rows inside any interval of
+    # their stay
+    keys = ['icustay_id','charttime_elapsed']
+    colNameMap = {'vent': 'vent',
+                  'vasopressor': 'vasopressor',
+                  'rrt_range': 'rrt'}
+    rangeTbl = ['vent','vasopressor','rrt_range']
+    dropCols = ['subject_id','hadm_id','storetime']
+
+    frames = dict()
+    for f in data.keys():
+        if f in rangeTbl:
+            continue
+        df_tmp = data[f]
+        df_tmp = df_tmp[[c for c in df_tmp.columns if c not in dropCols]].set_index(keys)
+        if not df_tmp.index.is_unique:
+            df_tmp = df_tmp.groupby(level=keys, sort=False).last()
+        frames[f] = df_tmp
+
+    counts = dict()
+    for df_tmp in frames.values():
+        for c in df_tmp.columns:
+            counts[c] = counts.get(c, 0) + 1
+    for f in frames:
+        frames[f] = frames[f].rename(columns=dict((c, c + '_' + f) for c in frames[f].columns if counts[c] > 1))
+
+    if interval_step is not None:
+        expanded = [_expand_intervals(data[f]['icustay_id'].values, data[f][range_start].values,
+                                      data[f][range_end].values, interval_step)
+                    for f in rangeTbl if f in data]
+        if expanded:
+            ids = np.concatenate([e[0] for e in expanded])
+            times = np.concatenate([e[1] for e in expanded])
+            # keep integer times as integers, if the point tables use them
+            time_dtypes = [df_tmp.index.get_level_values(1).dtype for df_tmp in frames.values()]
+            if time_dtypes and all(d.kind in 'iu' for d in time_dtypes) and np.all(times == np.round(times)):
+                times = times.astype(time_dtypes[0])
+            index = pd.MultiIndex.from_arrays([ids, times], names=keys).drop_duplicates()
+            frames['__intervals__'] = pd.DataFrame(index=index)
+
+    if frames:
+        df = pd.concat(list(frames.values()), axis=1, join='outer', sort=True).reset_index()
+    else:
+        df = pd.DataFrame(columns=keys)
+    df.columns = keys + list(df.columns[2:])
+
+    for f in rangeTbl:
+        if f not in data:
+            continue
+        df_rng = data[f]
+        df[colNameMap[f]] = _in_intervals(df['icustay_id'].values, df['charttime_elapsed'].values,
+                                          df_rng['icustay_id'].values,
+                                          df_rng[range_start].values, df_rng[range_end].values).astype(int)
+    return df
+
+
 def plot_xgb_importance_fmap(xgb_model, X_header=None, ax=None, height=0.2,
                     xlim=None, ylim=None, title='Feature importance',
                     xlabel='F score', ylabel='Features',
@@ -572,26 +987,182 @@ def load_design_matrix(co, df_additional_data=None, data_ext='', path=None, died
 
     return X, y, X_header
 
+# columns dropped by load_design_matrix
+DESIGN_MATRIX_VARS_TO_DELETE = ['bg_intubated_first', 'bg_ventilationrate_first', 'bg_ventilator_first',
+    'bg_intubated_last', 'bg_ventilationrate_last', 'bg_ventilator_last',
+    'rrt_min', 'vasopressor_min', 'vent_min',
+    'rrt_max', 'vasopressor_max', 'vent_max']
+
+def _parquet_available():
+    try:
+        import pyarrow
+    except ImportError:
+        try:
+            import fastparquet
+        except ImportError:
+            return False
+    return True
+
+def read_csv_columns(filename, usecols=None, parse_dates=None, cache_dir=None, cache_format=None):
+    # reads columns of a csv into a dataframe, through a binary columnar cache:
+    # on the first read, the whole csv is parsed once and saved as parquet (cache_format='parquet', the default
+    # when pyarrow or fastparquet is installed, as for the query cache in mimic_iv_utils) or, failing that,
+    # as one .npy file per column (cache_format='npy', datetimes as int64 nanoseconds). a manifest.json
+    # lists the columns. later reads only load usecols, which is a list of column names or, as in
+    # pd.read_csv, a function of the column name.
+    # the cache is rebuilt when the csv's size or modification time, or the cache format, change.
+    # cache_dir defaults to <filename>.columns
+    if cache_dir is None:
+        cache_dir = filename + '.columns'
+    if parse_dates is None:
+        parse_dates = list()
+    if cache_format is None:
+        cache_format = 'parquet' if _parquet_available() else 'npy'
+    manifest_file = os.path.join(cache_dir, 'manifest.json')
+    parquet_file = os.path.join(cache_dir, 'columns.parquet')
+
+    stat = os.stat(filename)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    manifest = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as fp:
+            manifest = json.load(fp)
+        if manifest['source'] != source or manifest.get('format', 'npy') != cache_format or \
+                any(c not in manifest['datetime'] for c in parse_dates):
+            manifest = None
+
+    if manifest is None:
+        df = pd.read_csv(filename)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        manifest = {'source': source, 'format': cache_format, 'columns': list(df.columns), 'datetime': list()}
+        data = dict()
+        for c in df.columns:
+            if c in parse_dates:
+                data[c] = pd.to_datetime(df[c]).values.astype('datetime64[ns]')
+                manifest['datetime'].append(c)
+            elif df[c].dtype == object:
+                data[c] = df[c].fillna('').values.astype(str)
+            else:
+                data[c] = df[c].values
+        if cache_format == 'parquet':
+            # write under a temporary name first, so readers never see a partial file
+            tmp_file = parquet_file + '.' + str(os.getpid()) + '.tmp'
+            pd.DataFrame(data, columns=list(df.columns)).to_parquet(tmp_file)
+            os.replace(tmp_file, parquet_file)
+        else:
+            for i, c in enumerate(df.columns):
+                values = data[c].view(np.int64) if c in manifest['datetime'] else data[c]
+                np.save(os.path.join(cache_dir, '{:05d}.npy'.format(i)), values, allow_pickle=False)
+        with open(manifest_file, 'w') as fp:
+            json.dump(manifest, fp)
+
+    columns = manifest['columns']
+    if usecols is None:
+        usecols = columns
+    elif callable(usecols):
+        usecols = [c for c in columns if usecols(c)]
+    usecols = list(usecols)
+
+    if cache_format == 'parquet':
+        df = pd.read_parquet(parquet_file, columns=usecols)
+        for c in usecols:
+            if c in manifest['datetime']:
+                df[c] = df[c].values.astype('datetime64[ns]')
+        return df[usecols]
+
+    data = dict()
+    for c in usecols:
+        values = np.load(os.path.join(cache_dir, '{:05d}.npy'.format(columns.index(c))), allow_pickle=False)
+        if c in manifest['datetime']:
+            values = values.view('datetime64[ns]')
+        data[c] = values
+    return pd.DataFrame(data, columns=usecols)
+
+def load_design_matrix_fast(co, df_additional_data=None, data_ext='', path=None, diedWithin=None, cache_dir=None,
+                            cache_format=None):
+    # same as load_design_matrix, but the csvs are read through read_csv_columns, only the needed columns
+    # are loaded, and X/y are returned as float32
+    # cache_dir, if given, holds the column caches of both csvs (in subdirectories named after them)
+    # cache_format is passed on to read_csv_columns
+    if path is None:
+        path = ''
+
+    if data_ext != '' and data_ext[0] != '_':
+        data_ext = '_' + data_ext
+
+    def _read(name, usecols=None, parse_dates=None):
+        filename = path + name + data_ext + '.csv'
+        file_cache = None if cache_dir is None else os.path.join(cache_dir, name + data_ext)
+        return read_csv_columns(filename, usecols=usecols, parse_dates=parse_dates, cache_dir=file_cache,
+                                cache_format=cache_format)
+
+    # load in the design matrix, without the columns load_design_matrix drops
+    df_design = _read('design_matrix', usecols=lambda c: c not in DESIGN_MATRIX_VARS_TO_DELETE)
+    df_design['icustay_id'] = df_design['icustay_id'].astype(int)
+    df_design.set_index('icustay_id', inplace=True)
+
+    # join these dfs together, add in the static vars
+    df = co.merge(df_design, how='left', left_index=True, right_index=True)
+    if df_additional_data is not None:
+        df = df.merge(df_additional_data, how='left', left_index=True, right_index=True)
+
+    # change y to be "died within X seconds", where X is specified by the user
+    if diedWithin is not None:
+        df_offset = _read('icustays_offset', usecols=['icustay_id','intime','starttime','deathtime'],
+                          parse_dates=['intime','outtime','deathtime'])
+        df_offset['icustay_id'] = df_offset['icustay_id'].astype(int)
+        df_offset = df_offset.set_index('icustay_id').reindex(df.index)
+
+        # compare in integer nanoseconds: deathtime < intime + starttime + diedWithin
+        deathtime = df_offset['deathtime'].values.view(np.int64)
+        cutoff = (df_offset['intime'].values.view(np.int64)
+                  + np.round(np.nan_to_num(df_offset['starttime'].values.astype(float)) * 1e9).astype(np.int64)
+                  + np.int64(diedWithin) * np.int64(10**9))
+        known = df_offset[['intime','starttime','deathtime']].notnull().all(axis=1).values
+        died = known & (deathtime < cutoff)
+        df['hospital_expire_flag'] = died.astype(int)
+
+    for v in DESIGN_MATRIX_VARS_TO_DELETE:
+        if v in df.columns:
+            df.drop(v, axis=1, inplace=True)
+
+    # move from a data frame into numpy arrays: the outcome is the first column
+    y = df.iloc[:,0].values.astype(np.float32)
+    X = df.iloc[:,1:].values.astype(np.float32)
+
+    # get a header row
+    X_header = list(df.columns[1:])
+
+    return X, y, X_header
+
 def get_predictions(df, df_static,  mdl, iid):
     df = df.loc[df['icustay_id']==iid,:]
-    tm = df['hr'].values
-    prob = list()
-    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = vars_of_interest()
+    df_pred = get_predictions_batch(df, df_static, mdl, icustay_ids=[iid])
+    return df_pred['hr'].values, list(df_pred['prob'].values)
 
-    for t in tm:
-        time_dict = {iid: t}
-        X = get_design_matrix(df, time_dict, W=4, W_extra=24)
 
-        # first, the data from static vars from df_static
-        X = X.merge(df_static.set_index('icustay_id')[var_static], how='left', left_index=True, right_index=True)
+def get_predictions_batch(df, df_static, mdl, icustay_ids=None, times=None, W=4, W_extra=24):
+    # predictions for many (icustay_id, time) pairs, with a single predict_proba call
+    # by default, every hour of every stay in df (or in icustay_ids) is scored, as in get_predictions
+    # times, if given, are paired with icustay_ids instead
+    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = vars_of_interest()
+
+    if times is None:
+        df_times = df[['icustay_id','hr']]
+        if icustay_ids is not None:
+            df_times = df_times.loc[df_times['icustay_id'].isin(icustay_ids),:]
+        icustay_ids, times = df_times['icustay_id'].values, df_times['hr'].values
 
-        # convert to numpy data
-        X = X.values
+    X = get_design_matrix_at_times(df, icustay_ids, times, W=W, W_extra=W_extra)
+    df_pred = X[['icustay_id','hr']].copy()
 
-        curr_prob = mdl.predict_proba(X)
-        prob.append(curr_prob[0,1])
+    # the data from static vars from df_static, in the same order as the rows of X
+    X_static = df_static.set_index('icustay_id')[var_static].reindex(df_pred['icustay_id'].values)
+    X = np.column_stack([X.drop(['icustay_id','hr'], axis=1).values, X_static.values])
 
-    return tm, prob
+    df_pred['prob'] = mdl.predict_proba(X)[:,1] if X.shape[0] > 0 else np.zeros(0)
+    return df_pred
 
 
 def get_data_at_time(df, df_static, iid, hour=0):
@@ -0,0 +1,86 @@
+# time the note token export in notes_io_util on synthetic notes, and check that index.csv and the hourly
+# note index both resolve to the right notes in the token arrays
+# usage: python benchmark_notes_io_util.py [n_notes]
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+import notes_io_util
+
+
+def make_synthetic_notes(n_notes=20000, n_stays=500, seed=0):
+    # notes shaped like the output of save_notes (one sentence per line), deliberately not in (icustay_id,
+    # charttime) order, and the static data needed to align them to hours_in
+    rng = np.random.RandomState(seed)
+    words = np.array(['w%d' % i for i in range(2000)] + ['[**Hospital 12**]', '.', ','])
+    texts = ['\n'.join(' '.join(rng.choice(words, rng.randint(1, 30))) for _ in range(rng.randint(0, 8)))
+             for _ in range(n_notes)]
+
+    icustay_id = 200001 + rng.randint(0, n_stays, size=n_notes)
+    intime = pd.Timestamp('2100-01-01') + pd.to_timedelta(np.arange(n_stays) * 10**6, 's')
+    charttime = intime[icustay_id - 200001] + pd.to_timedelta(rng.randint(-3600, 10**5, size=n_notes), 's')
+    notes = pd.DataFrame({
+        'subject_id': icustay_id - 100000, 'hadm_id': icustay_id + 100000, 'icustay_id': icustay_id,
+        'charttime': charttime, 'category': 'Nursing', 'description': 'Report', 'text': texts,
+    }).set_index(['subject_id', 'hadm_id', 'icustay_id'])
+
+    data = pd.DataFrame({
+        'icustay_id': 200001 + np.arange(n_stays), 'intime': intime, 'outtime': intime + pd.Timedelta(hours=24),
+    })
+    return notes, data
+
+
+def note_text_ids(tensors, note_id):
+    # the token ids of note note_id, in one array
+    sentences = notes_io_util.get_note_tokens(tensors, note_id)
+    return np.concatenate(sentences) if sentences else np.zeros(0, dtype=np.int32)
+
+
+def expected_text_ids(text, vocab):
+    token_ids = {t: i for i, t in enumerate(vocab)}
+    unk_id = token_ids[notes_io_util.UNK_TOKEN]
+    sentences = notes_io_util.tokenize_note_text(text)
+    return np.array([token_ids.get(t, unk_id) for s in sentences for t in s], dtype=np.int32)
+
+
+if __name__ == '__main__':
+    n_notes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    notes, data = make_synthetic_notes(n_notes)
+    out_dir = tempfile.mkdtemp()
+
+    start = time.time()
+    vocab = notes_io_util.save_note_tensors(notes, out_dir, data=data, min_count=2)
+    print('save_note_tensors: {:.3f} sec'.format(time.time() - start))
+
+    tensors = notes_io_util.load_note_tensors(out_dir)
+    index = tensors['index']
+    assert (index['note_id'].values == np.arange(len(notes))).all()
+
+    # index.csv joined to the token arrays gives back each note's text and ids
+    flat = notes.reset_index()
+    rng = np.random.RandomState(1)
+    for note_id in rng.choice(len(index), size=min(200, len(index)), replace=False):
+        row = index.iloc[note_id]
+        match = flat[(flat['icustay_id'] == row['icustay_id']) & (flat['charttime'] == row['charttime'])]
+        assert len(match) == 1
+        assert (note_text_ids(tensors, note_id) == expected_text_ids(match['text'].iloc[0], vocab)).all()
+
+    # the hourly note index points at the same notes
+    start = time.time()
+    notes_hourly, note_ids = notes_io_util.build_hourly_note_index(notes, data)
+    print('build_hourly_note_index: {:.3f} sec'.format(time.time() - start))
+    for (subject_id, hadm_id, icustay_id, hours_in), (note_start, note_stop) in notes_hourly.iloc[:200].iterrows():
+        for note_id in note_ids.values[note_start:note_stop]:
+            row = index.iloc[note_id]
+            assert row['icustay_id'] == icustay_id and row['hours_in'] == hours_in
+    # and every note of index.csv on the grid is in it, at its hours_in
+    hourly = np.zeros(len(index), dtype=np.int64) - 1
+    for (subject_id, hadm_id, icustay_id, hours_in), (note_start, note_stop) in notes_hourly.iterrows():
+        hourly[note_ids.values[note_start:note_stop]] = hours_in
+    assert (hourly == index['hours_in'].values).all(), (hourly != index['hours_in'].values).sum()
+    assert (index['hours_in'] == -1).any()
+    print('{} notes, {} aligned to the hourly grid. Outputs match.'.format(len(notes), len(note_ids)))
+    shutil.rmtree(out_dir)
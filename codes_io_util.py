@@ -0,0 +1,132 @@
+import os, numpy as np, pandas as pd, scipy.sparse
+
+ID_COLS = ['subject_id', 'hadm_id', 'icustay_id']
+
+def encode_codes(codes, column='icd9_codes', vocab=None):
+    """ Multi-hot encode a column of code lists (as returned by codes.sql's array_agg).
+
+    Args
+    ----
+    codes : pd.DataFrame
+        One row per stay; codes[column] holds a list of codes per row. Missing codes (None) are skipped.
+    vocab : list of str or None
+        Reuse an existing code vocabulary; codes not in it are dropped. Built from codes[column] if None.
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix of int8, shape (len(codes), len(vocab))
+    vocab : list of str
+    """
+    lists = [c if isinstance(c, (list, tuple, np.ndarray)) else [] for c in codes[column]]
+    lengths = np.fromiter((len(c) for c in lists), dtype=np.int64, count=len(lists))
+    flat = pd.Series(np.concatenate([np.asarray(c, dtype=object) for c in lists]) if len(lists) else [], dtype=object)
+    rows = np.repeat(np.arange(len(lists), dtype=np.int64), lengths)
+
+    present = flat.notnull().values
+    flat, rows = flat[present].astype(str), rows[present]
+
+    if vocab is None:
+        vocab = sorted(flat.unique())
+    cols = pd.Index(vocab).get_indexer(flat.values)
+    known = cols >= 0
+
+    matrix = scipy.sparse.coo_matrix(
+        (np.ones(known.sum(), dtype=np.int8), (rows[known], cols[known])), shape=(len(lists), len(vocab))
+    ).tocsr()
+    matrix.sum_duplicates()
+    matrix.data[:] = 1 # multi-hot, even if a code is listed twice for a stay
+    return matrix, list(vocab)
+
+def save_sparse_codes(codes, prefix, ccs_column='ccs_codes'):
+    """ Save a codes frame as sparse stay x code matrices, readable without unpickling.
+
+    Writes:
+        <prefix>_ids.npy          int64, (n_stays, 3) subject_id, hadm_id, icustay_id of each matrix row.
+        <prefix>_icd9.npz         scipy.sparse CSR multi-hot matrix.
+        <prefix>_icd9_vocab.txt   code of each matrix column, one per line.
+        <prefix>_ccs.npz / <prefix>_ccs_vocab.txt
+                                  the same, grouped by CCS category, if codes has ccs_column.
+
+    Args
+    ----
+    codes : pd.DataFrame
+        index = ID_COLS, as returned by save_icd9_codes.
+    """
+    ids = codes.reset_index()[ID_COLS].values.astype(np.int64)
+    np.save(prefix + '_ids.npy', ids)
+
+    outputs = [('icd9', 'icd9_codes')]
+    if ccs_column in codes.columns: outputs.append(('ccs', ccs_column))
+
+    for name, column in outputs:
+        matrix, vocab = encode_codes(codes, column=column)
+        scipy.sparse.save_npz(prefix + '_' + name + '.npz', matrix)
+        with open(prefix + '_' + name + '_vocab.txt', 'w') as f: f.write('\n'.join(vocab))
+        print("Saved %s matrix: %d stays x %d codes, %d nonzero" % (name, matrix.shape[0], matrix.shape[1], matrix.nnz))
+
+def load_sparse_codes(prefix, name='icd9'):
+    """ Load a matrix written by save_sparse_codes.
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+    vocab : list of str
+    index : pd.MultiIndex
+        ID_COLS of each matrix row.
+    """
+    matrix = scipy.sparse.load_npz(prefix + '_' + name + '.npz')
+    with open(prefix + '_' + name + '_vocab.txt') as f: vocab = f.read().splitlines()
+    ids = np.load(prefix + '_ids.npy', allow_pickle=False)
+    index = pd.MultiIndex.from_arrays([ids[:, i] for i in range(ids.shape[1])], names=ID_COLS)
+    return matrix, vocab, index
+
+def sparse_codes_exist(prefix, name='icd9'):
+    return all(os.path.isfile(prefix + s) for s in ('_ids.npy', '_' + name + '.npz', '_' + name + '_vocab.txt'))
+
+def align_codes_to_index(codes, hourly_index):
+    """ Align per-stay codes to an hourly index (e.g. vitals_labs) without repeating them for every hour.
+
+    Args
+    ----
+    codes : pd.DataFrame
+        index = ID_COLS, one row per stay.
+    hourly_index : pd.MultiIndex
+        ID_COLS + ['hours_in'], grouped by stay (as vitals_labs is, being sorted).
+
+    Returns
+    -------
+    codes : pd.DataFrame
+        index = ID_COLS, one row per stay of hourly_index, in the same order. Stays without codes are NaN.
+    stay_offsets : pd.DataFrame
+        index = ID_COLS as above. Columns row_start and row_stop: stay k covers rows
+        row_start[k]:row_stop[k] of hourly_index.
+    """
+    stay_ids = np.column_stack([hourly_index.get_level_values(c).values for c in ID_COLS])
+    is_start = np.ones(len(stay_ids), dtype=bool)
+    if len(stay_ids) > 1: is_start[1:] = (stay_ids[1:] != stay_ids[:-1]).any(axis=1)
+    starts = np.flatnonzero(is_start)
+
+    stay_index = pd.MultiIndex.from_arrays([stay_ids[starts, i] for i in range(len(ID_COLS))], names=ID_COLS)
+    assert stay_index.is_unique, "hourly_index must be grouped by stay."
+
+    stay_offsets = pd.DataFrame(
+        {'row_start': starts.astype(np.int64), 'row_stop': np.append(starts[1:], len(stay_ids)).astype(np.int64)},
+        index=stay_index,
+    )
+    return codes.reindex(stay_index), stay_offsets
+
+def codes_for_rows(codes, stay_offsets, rows):
+    """ Lazily broadcast aligned codes to rows of the hourly index they were aligned to.
+
+    Args
+    ----
+    codes, stay_offsets : outputs of align_codes_to_index.
+    rows : array-like of int
+        Positions in the hourly index.
+
+    Returns
+    -------
+    codes : pd.DataFrame, one row per element of rows.
+    """
+    stay_pos = np.searchsorted(stay_offsets['row_start'].values, np.asarray(rows), side='right') - 1
+    return codes.iloc[stay_pos]
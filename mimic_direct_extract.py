@@ -27,6 +27,9 @@ from datapackage_io_util import (
 )
 from heuristic_sentence_splitter import sent_tokenize_rules
 from mimic_querier import *
+from codes_io_util import align_codes_to_index, save_sparse_codes, sparse_codes_exist
+from note_cache import NOTE_CACHE_MAX_BYTES, NoteCache, spacy_pipeline_signature
+from notes_io_util import build_hourly_note_index, save_note_tensors
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 SQL_DIR = os.path.join(CURRENT_DIR, 'SQL_Queries')
@@ -46,7 +49,9 @@ dynamic_hd5_filename = 'vitals_hourly_data.h5'
 dynamic_hd5_filt_filename = 'all_hourly_data.h5'
 
 codes_hd5_filename = 'C.h5'
+codes_sparse_prefix = 'C_sparse'
 notes_hd5_filename = 'notes.hdf' # N.h5
+notes_tokens_dirname = 'notes_tokens'
 idx_hd5_filename = 'C_idx.h5'
 
 outcome_filename = 'outcomes_hourly_data.csv'
@@ -326,7 +331,17 @@ def save_numerics(
 
     return X
 
-def save_notes(notes, outPath=None, notes_h5_filename=None):
+def save_notes(notes, outPath=None, notes_h5_filename=None, cache_path=None, cache_max_bytes=NOTE_CACHE_MAX_BYTES):
+    """ Sentence-split and clean note text with spaCy.
+
+    Args
+    ----
+    cache_path : str or None
+        If given, processed text is looked up in / stored to a persistent NoteCache at this path, keyed by the
+        note text and the spaCy pipeline, so re-running extraction only processes new notes.
+    cache_max_bytes : int or None
+        Size bound of the note cache; least recently used entries are evicted beyond it. None means unbounded.
+    """
     notes_id_cols = list(set(ID_COLS).intersection(notes.columns))# + ['row_id'] TODO: what is row_id?
     notes_metadata_cols = ['chartdate', 'charttime', 'category', 'description']
 
@@ -359,6 +374,10 @@ def save_notes(notes, outPath=None, notes_h5_filename=None):
     nlp.add_pipe(sbd_component, before='parser')  # insert before the parser
     disabled = nlp.disable_pipes('ner')
 
+    cache = None
+    if cache_path is not None:
+        cache = NoteCache(cache_path, pipeline_signature=spacy_pipeline_signature(nlp), max_bytes=cache_max_bytes)
+
     def process_sections_helper(section, note, processed_sections):
         processed_section = nlp(section['sections'])
         processed_section = fix_deid_tokens(section['sections'], processed_section)
@@ -386,26 +405,48 @@ def save_notes(notes, outPath=None, notes_h5_filename=None):
         try:
             note_text = str(note['text'])
             note['text'] = ''
+            if cache is not None:
+                cached_text = cache.get(note_text)
+                if cached_text is not None:
+                    note['text'] = cached_text
+                    return note
+
             processed_sections = process_note_willie_spacy(note_text)
             ps = {'sections': processed_sections}
             ps = pd.DataFrame(ps)
 
             ps.apply(get_sentences, args=(note,), axis=1)
 
+            if cache is not None: cache.put(note_text, note['text'])
             return note 
         except Exception as e:
             print('error', e)
             #raise e
 
-    notes = notes.apply(process_frame_text, axis=1)
+    try:
+        notes = notes.apply(process_frame_text, axis=1)
+
+        if cache is not None:
+            stats = cache.stats()
+            print(
+                "Notes cache: %d hits, %d misses (%.1f%% hit rate), %d evicted, %d entries / %d bytes" % (
+                    stats['hits'], stats['misses'], 100 * stats['hit_rate'], stats['evictions'], stats['entries'],
+                    stats['bytes']
+                )
+            )
+    finally:
+        # commits the notes processed so far even if the apply fails, so a re-run doesn't redo them
+        if cache is not None: cache.close()
 
     if outPath is not None and notes_h5_filename is not None:
         notes.to_hdf(os.path.join(outPath, notes_h5_filename), 'notes')
     return notes
 
-def save_icd9_codes(codes, outPath, codes_h5_filename):
+def save_icd9_codes(codes, outPath, codes_h5_filename, codes_sparse_prefix=None):
     codes.set_index(ID_COLS, inplace=True)
     codes.to_hdf(os.path.join(outPath, codes_h5_filename), 'C')
+    # Also store as sparse multi-hot matrices, which load without unpickling lists.
+    if codes_sparse_prefix is not None: save_sparse_codes(codes, os.path.join(outPath, codes_sparse_prefix))
     return codes
 
 def save_outcome(
@@ -721,6 +762,15 @@ if __name__ == '__main__':
     ap.add_argument('--extract_notes', type=int, default=1,
                     help='Whether or not to extract notes: 0 - no extraction, ' +
                     '1 - extract if not present in the data directory, 2 - extract even if there is data')
+    ap.add_argument('--notes_cache_path', type=str, default=None,
+                    help='SQLite file caching processed note text across runs. No caching if not given.')
+    ap.add_argument('--notes_cache_max_mb', type=float, default=NOTE_CACHE_MAX_BYTES / 1024**2,
+                    help='Maximum size of the notes cache in MB; least recently used notes are evicted beyond it.')
+    ap.add_argument('--export_note_tokens', type=int, default=0,
+                    help='Whether to also write notes as memory-mappable token-id arrays with a vocabulary: ' +
+                    '0 - no export, 1 - export if not present in the data directory, 2 - export even if present')
+    ap.add_argument('--notes_vocab_min_count', type=int, default=5,
+                    help='Minimum number of occurrences for a token to be in the exported notes vocabulary.')
     ap.add_argument('--pop_size', type=int, default=0,
                     help='Size of population to extract')
     ap.add_argument('--exit_after_loading', type=int, default=0)
@@ -797,7 +847,9 @@ if __name__ == '__main__':
         outcome_hd5_filename = splitext(outcome_hd5_filename)[0] + '_' + pop_size + splitext(outcome_hd5_filename)[1]
         #outcome_columns_filename = splitext(outcome_columns_filename)[0] + '_' + pop_size + splitext(outcome_columns_filename)[1]
         codes_hd5_filename = splitext(codes_hd5_filename)[0] + '_' + pop_size + splitext(codes_hd5_filename)[1]
+        codes_sparse_prefix = codes_sparse_prefix + '_' + pop_size
         notes_hd5_filename = splitext(notes_hd5_filename)[0] + '_' + pop_size + splitext(notes_hd5_filename)[1]
+        notes_tokens_dirname = notes_tokens_dirname + '_' + pop_size
         idx_hd5_filename = splitext(idx_hd5_filename)[0] + '_' + pop_size + splitext(idx_hd5_filename)[1]
 
     dbname = args['psql_dbname']
@@ -932,10 +984,12 @@ if __name__ == '__main__':
     if ( (args['extract_codes'] == 0) or (args['extract_codes'] == 1) ) and isfile(os.path.join(outPath, codes_hd5_filename)):
         print("Reloading codes from %s" % os.path.join(outPath, codes_hd5_filename))
         C = pd.read_hdf(os.path.join(outPath, codes_hd5_filename))
+        if not sparse_codes_exist(os.path.join(outPath, codes_sparse_prefix)):
+            save_sparse_codes(C, os.path.join(outPath, codes_sparse_prefix))
     elif ( (args['extract_codes'] == 1) and (not isfile(os.path.join(outPath, codes_hd5_filename))) ) or (args['extract_codes'] == 2):
         print("Saving codes...")
         codes = querier.query(query_file=CODES_QUERY_PATH)
-        C = save_icd9_codes(codes, outPath, codes_hd5_filename)
+        C = save_icd9_codes(codes, outPath, codes_hd5_filename, codes_sparse_prefix)
 
     if C is None: print("SKIPPED codes_data")
     else:         print("LOADED codes_data")
@@ -949,11 +1003,21 @@ if __name__ == '__main__':
     elif ( (args['extract_notes'] == 1) and (not isfile(os.path.join(outPath, notes_hd5_filename))) ) or (args['extract_notes'] == 2):
         print("Saving notes...")
         notes = querier.query(query_file=NOTES_QUERY_PATH)
-        N = save_notes(notes, outPath, notes_hd5_filename)
+        N = save_notes(
+            notes, outPath, notes_hd5_filename, cache_path=args['notes_cache_path'],
+            cache_max_bytes=int(args['notes_cache_max_mb'] * 1024**2),
+        )
 
     if N is None: print("SKIPPED notes_data")
     else:         print("LOADED notes_data")
 
+    notes_tokens_dir = os.path.join(outPath, notes_tokens_dirname)
+    if N is not None and (
+        (args['export_note_tokens'] == 1 and not isdir(notes_tokens_dir)) or (args['export_note_tokens'] == 2)
+    ):
+        print("Saving note tokens...")
+        save_note_tensors(N, notes_tokens_dir, data=data, min_count=args['notes_vocab_min_count'])
+
     #############
     # If there is outcome extraction
     Y = None
@@ -973,7 +1037,7 @@ if __name__ == '__main__':
     if C is not None: print("Codes", C.shape, C.index.names, C.columns.names)
     if N is not None: print("Notes", N.shape, N.index.names, N.columns.names)
 
-    # TODO(mmd): Do we want to align N like the others? Seems maybe wrong?
+    # N itself stays unaligned (one row per note); build_hourly_note_index below gives its hourly alignment.
 
     print(data.shape, data.index.names, data.columns.names)
     if args['exit_after_loading']:
@@ -984,11 +1048,19 @@ if __name__ == '__main__':
     #X = X.loc[shared_idx]
     # TODO(mmd): Why does this work?
     Y = Y.loc[shared_idx]
-    # Problems start here.
-    if C is not None: C = C.loc[shared_idx]
+    # Codes are per stay, so keep them that way rather than repeating them for every hour of shared_idx.
+    # codes_stay_offsets maps each stay to its rows of X; see codes_io_util.codes_for_rows.
+    codes_stay_offsets = None
+    if C is not None: C, codes_stay_offsets = align_codes_to_index(C, shared_idx)
     data = data[data.index.get_level_values('icustay_id').isin(set(shared_sub))]
     data = data.reset_index().set_index(ID_COLS)
 
+    # Bin notes onto the same hourly grid as X. Note ids are as in notes_io_util.sort_notes (and the note tokens export).
+    notes_hourly, notes_hourly_ids = None, None
+    if N is not None:
+        notes_hourly, notes_hourly_ids = build_hourly_note_index(N, data)
+        print('Notes aligned to the hourly grid : %d / %d' % (len(notes_hourly_ids), len(N)))
+
     # Map the lowering function to all column names
     X.columns = pd.MultiIndex.from_tuples(
         [tuple((str(l).lower() for l in cols)) for cols in X.columns], names=X.columns.names
@@ -1018,6 +1090,10 @@ if __name__ == '__main__':
     X.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'vitals_labs')
     Y.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'interventions')
     if C is not None: C.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'codes')
+    if C is not None: codes_stay_offsets.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'codes_stay_offsets')
+    if notes_hourly is not None:
+        notes_hourly.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'notes_hourly')
+        notes_hourly_ids.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'notes_hourly_ids')
     data.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'patients', format='table')
     #fencepost.to_hdf(os.path.join(outPath, dynamic_hd5_filt_filename), 'fencepost')
 
@@ -0,0 +1,138 @@
+import hashlib, sqlite3, time
+
+# Bump whenever the note processing in mimic_direct_extract.save_notes changes in a way that alters its output
+# (sentence boundary rules, de-id token merging, sentence joining), so stale entries are never returned.
+NOTES_PIPELINE_VERSION = 1
+
+# Default bound on the size of a NoteCache (2GB of processed text).
+NOTE_CACHE_MAX_BYTES = 2 * 1024**3
+
+def spacy_pipeline_signature(nlp, extra=''):
+    """ Describe a loaded spaCy pipeline, so cache entries are tied to the exact pipeline that made them.
+
+    Returns
+    -------
+    signature : str
+    """
+    import spacy
+    meta = getattr(nlp, 'meta', {}) or {}
+    return '|'.join(str(x) for x in (
+        'notes_v%d' % NOTES_PIPELINE_VERSION,
+        'spacy=%s' % spacy.__version__,
+        '%s=%s' % (meta.get('lang', ''), meta.get('name', '')),
+        'model=%s' % meta.get('version', ''),
+        'pipes=%s' % ','.join(nlp.pipe_names),
+        extra,
+    ))
+
+class NoteCache():
+    def __init__(self, path, pipeline_signature='', max_bytes=NOTE_CACHE_MAX_BYTES, commit_every=1000):
+        """ A persistent, size-bounded cache of processed note text, backed by a single SQLite file.
+
+        Entries are keyed by a hash of (note text, pipeline_signature). When the stored processed text exceeds
+        max_bytes, the least recently used entries are evicted.
+
+        Args
+        ----
+        path : str
+            SQLite file. Created if it does not exist.
+        pipeline_signature : str
+            Identifies the processing pipeline (see spacy_pipeline_signature).
+        max_bytes : int or None
+            Bound on the total size of stored processed text. None means unbounded.
+        commit_every : int
+            Number of writes between commits.
+        """
+        self.path               = path
+        self.pipeline_signature = pipeline_signature
+        self.max_bytes          = max_bytes
+        self.commit_every       = commit_every
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._pending = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS notes ('
+            '  key TEXT PRIMARY KEY, processed TEXT NOT NULL, nbytes INTEGER NOT NULL, last_used REAL NOT NULL'
+            ')'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS notes_last_used ON notes (last_used)')
+        self.connection.commit()
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM notes').fetchone()[0]
+
+    def key(self, text):
+        h = hashlib.sha1(self.pipeline_signature.encode('utf-8'))
+        h.update(b'\0')
+        h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, text):
+        """ Returns the processed text for `text`, or None on a miss. """
+        key = self.key(text)
+        row = self.connection.execute('SELECT processed FROM notes WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute('UPDATE notes SET last_used = ? WHERE key = ?', (time.time(), key))
+        self._wrote()
+        return row[0]
+
+    def put(self, text, processed):
+        key, nbytes = self.key(text), len(processed.encode('utf-8'))
+        if self.max_bytes is not None and nbytes > self.max_bytes: return
+
+        old = self.connection.execute('SELECT nbytes FROM notes WHERE key = ?', (key,)).fetchone()
+        if old is not None: self.total_bytes -= old[0]
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO notes (key, processed, nbytes, last_used) VALUES (?, ?, ?, ?)',
+            (key, processed, nbytes, time.time())
+        )
+        self.total_bytes += nbytes
+        self.evict()
+        self._wrote()
+
+    def evict(self):
+        """ Drops least recently used entries until the cache fits in max_bytes. """
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes: return
+
+        cursor = self.connection.execute('SELECT key, nbytes FROM notes ORDER BY last_used ASC')
+        to_delete = []
+        for key, nbytes in cursor:
+            if self.total_bytes <= self.max_bytes: break
+            to_delete.append((key,))
+            self.total_bytes -= nbytes
+        cursor.close()
+
+        self.connection.executemany('DELETE FROM notes WHERE key = ?', to_delete)
+        self.evictions += len(to_delete)
+
+    def _wrote(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.connection.commit()
+            self._pending = 0
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate(), 'evictions': self.evictions,
+            'entries': len(self), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+        }
+
+    def close(self):
+        if self.connection is None: return
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
@@ -0,0 +1,149 @@
+# time GRUD.forward on CPU against sequence length, and the eager against the fused (TorchScript) recurrence,
+# on random inputs
+# usage: python benchmark_grud.py [batch_size] [n_vars] [hidden_size]
+import copy
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import torch
+
+from mmd_grud_utils import GRUD, prepare_dataloader
+
+
+def make_random_batch(batch_size, n_hours, n_vars, seed=0):
+    # X, X_last_obsv, Mask, Delta, each (batch, time, feature)
+    rng = np.random.RandomState(seed)
+    X = rng.randn(batch_size, n_hours, n_vars).astype(np.float32)
+    Mask = (rng.rand(batch_size, n_hours, n_vars) < 0.3).astype(np.float32)
+    Delta = rng.randint(0, 10, size=(batch_size, n_hours, n_vars)).astype(np.float32)
+    return [torch.from_numpy(a) for a in (X, X, Mask, Delta)]
+
+
+def make_imputed_frame(n_stays, n_hours, n_vars, seed=0):
+    # an imputed frame, (subject, hadm, icustay, hours_in) X (var, mask/mean/time_since_measured), with the
+    # rows of the stays interleaved, and the labels as a shuffled Ys; the first variable is always measured, and
+    # its mean is +1 for stays labelled 1 and -1 for the others
+    rng = np.random.RandomState(seed)
+    subject_id = np.tile(rng.permutation(n_stays), n_hours)
+    hours_in = np.repeat(np.arange(n_hours), n_stays)
+    index = pd.MultiIndex.from_arrays(
+        [subject_id, subject_id + 100000, subject_id + 200000, hours_in],
+        names=['subject_id', 'hadm_id', 'icustay_id', 'hours_in'])
+    label = rng.randint(0, 2, size=n_stays)
+
+    mask = (rng.rand(len(index), n_vars) < 0.3).astype(np.float32)
+    mean = rng.randn(len(index), n_vars).astype(np.float32)
+    mask[:, 0], mean[:, 0] = 1, 2 * label[subject_id] - 1
+    values = np.stack([mask, mean, np.zeros_like(mask)], axis=2).reshape(len(index), 3 * n_vars)
+    columns = pd.MultiIndex.from_product([['v%d' % v for v in range(n_vars)], ['mask', 'mean', 'time_since_measured']])
+    df = pd.DataFrame(values, index=index, columns=columns)
+
+    order = rng.permutation(n_stays)
+    Ys = pd.Series(label[order], index=pd.MultiIndex.from_arrays(
+        [order, order + 100000, order + 200000], names=['subject_id', 'hadm_id', 'icustay_id']))
+    return df, Ys
+
+
+def forward_concat(model, X, X_last_obsv, Mask, Delta):
+    # GRUD.forward as it was: every hidden state is prepended to the outputs with torch.cat
+    Hidden_State = model.initHidden(X.size(0))
+    outputs = None
+    for i in range(X.size(1)):
+        Hidden_State = model.step(
+            torch.squeeze(X[:, i:i + 1, :], 1),
+            torch.squeeze(X_last_obsv[:, i:i + 1, :], 1),
+            torch.squeeze(model.X_mean[:, i:i + 1, :], 1),
+            Hidden_State,
+            torch.squeeze(Mask[:, i:i + 1, :], 1),
+            torch.squeeze(Delta[:, i:i + 1, :], 1),
+        )
+        if outputs is None:
+            outputs = Hidden_State.unsqueeze(1)
+        else:
+            outputs = torch.cat((Hidden_State.unsqueeze(1), outputs), 1)
+    return model.drop(model.bn(model.fc(Hidden_State))), outputs
+
+
+def train_step(model, optimizer, inputs, labels):
+    optimizer.zero_grad()
+    loss = torch.nn.functional.cross_entropy(model(*inputs), labels)
+    loss.backward()
+    optimizer.step()
+
+
+def time_it(f, *args, **kwargs):
+    # best of 3
+    times = []
+    for _ in range(3):
+        start = time.time()
+        result = f(*args, **kwargs)
+        times.append(time.time() - start)
+    return result, min(times)
+
+
+if __name__ == '__main__':
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    n_vars = int(sys.argv[2]) if len(sys.argv) > 2 else 104
+    hidden_size = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    torch.manual_seed(0)
+
+    # prepare_dataloader pairs each stay with its own label, whatever the order of Ys
+    df, Ys = make_imputed_frame(4 * batch_size, 12, n_vars)
+    n_batches = 0
+    for X, X_last_obsv, Mask, Delta, label in prepare_dataloader(df, Ys, batch_size, shuffle=True):
+        assert (label == (X[:, 0, 0] > 0).long()).all()
+        n_batches += 1
+    assert n_batches == 4
+    print('prepare_dataloader: labels match their stays.')
+
+    print('batch_size={}, n_vars={}, hidden_size={}, threads={}'.format(
+        batch_size, n_vars, hidden_size, torch.get_num_threads()))
+    print('{:>6} {:>14} {:>14} {:>14}'.format('hours', 'concat (sec)', 'last (sec)', 'states (sec)'))
+    for n_hours in [24, 48, 96, 192, 384]:
+        model = GRUD(n_vars, n_vars, hidden_size, np.random.rand(1, n_hours, n_vars), batch_size=batch_size)
+        model.eval()
+        inputs = make_random_batch(batch_size, n_hours, n_vars)
+
+        with torch.no_grad():
+            (y_ref, states_ref), t_ref = time_it(forward_concat, model, *inputs)
+            y_last, t_last = time_it(model, *inputs)
+            (y_states, states), t_states = time_it(model, *inputs, return_states=True)
+
+        assert torch.allclose(y_ref, y_last) and torch.allclose(y_ref, y_states)
+        # the old outputs were in reverse time order
+        assert torch.allclose(states_ref.flip(1), states)
+        print('{:>6} {:>14.4f} {:>14.4f} {:>14.4f}'.format(n_hours, t_ref, t_last, t_states))
+    print('Outputs match.')
+
+    # eager vs fused (and TorchScript compiled fused), in time steps (of the whole batch) per second
+    warnings.simplefilter('ignore', FutureWarning) # torch.jit.script is deprecated in recent torch versions
+    n_hours = 96
+    eager = GRUD(n_vars, n_vars, hidden_size, np.random.rand(1, n_hours, n_vars), batch_size=batch_size)
+    models = [('eager', eager)]
+    for fused in (True, 'script'):
+        model = copy.deepcopy(eager)
+        model.fused = fused
+        models.append(('fused' if fused is True else 'scripted', model))
+    inputs = make_random_batch(batch_size, n_hours, n_vars)
+    labels = torch.randint(0, 2, (batch_size,))
+
+    print('{} hours: {:>10} {:>10} {:>10}'.format(n_hours, *[name for name, _ in models]))
+    forward_times, train_times = [], []
+    for name, model in models:
+        model.eval()
+        with torch.no_grad():
+            for _ in range(3): model(*inputs) # TorchScript compiles and optimizes over the first few calls
+            y, t = time_it(model, *inputs)
+        if name == 'eager': y_eager = y
+        assert torch.allclose(y_eager, y, atol=1e-5), (y_eager - y).abs().max()
+        forward_times.append(t)
+
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        for _ in range(3): train_step(model, optimizer, inputs, labels)
+        train_times.append(time_it(train_step, model, optimizer, inputs, labels)[1])
+
+    print('  forward steps/sec: {:>10.0f} {:>10.0f} {:>10.0f}'.format(*[n_hours / t for t in forward_times]))
+    print('  train steps/sec:   {:>10.0f} {:>10.0f} {:>10.0f}'.format(*[n_hours / t for t in train_times]))
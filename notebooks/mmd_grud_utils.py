@@ -1,4 +1,4 @@
-import copy, math, os, pickle, time, pandas as pd, numpy as np, scipy.stats as ss
+import copy, json, math, multiprocessing, os, pickle, shutil, time, pandas as pd, numpy as np, scipy.stats as ss
 
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
@@ -7,22 +7,220 @@ from sklearn.metrics import average_precision_score, roc_auc_score, accuracy_sco
 import torch, torch.utils.data as utils, torch.nn as nn, torch.nn.functional as F, torch.optim as optim
 from torch.autograd import Variable
 from torch.nn.parameter import Parameter
+from typing import List
 
 def to_3D_tensor(df):
     idx = pd.IndexSlice
     return np.dstack((df.loc[idx[:,:,:,i], :].values for i in sorted(set(df.index.get_level_values('hours_in')))))
+
+def _sort_stay_rows(df, max_hours=None):
+    """
+    Sorts the rows of df once by (stay, hours_in), dropping hours outside [0, max_hours).
+    Stays are numbered in order of first appearance in df; stay k is rows offsets[k]:offsets[k+1] of the sort.
+    """
+    hours = df.index.get_level_values('hours_in').values.astype(np.int64)
+    codes, stays = pd.factorize(df.index.droplevel('hours_in'))
+    if max_hours is None: max_hours = int(hours.max()) + 1 if len(hours) else 0
+
+    order = np.lexsort((hours, codes))
+    order = order[(hours[order] >= 0) & (hours[order] < max_hours)]
+    codes, hours = codes[order], hours[order]
+    offsets = np.searchsorted(codes, np.arange(len(stays) + 1))
+    return order, codes, hours, offsets, stays, max_hours
+
+def _stay_lengths(hours, offsets):
+    # rows are sorted by stay, so each stay's last row is just before the next stay's offset
+    lengths = np.zeros(len(offsets) - 1, dtype=np.int64)
+    has_rows = offsets[1:] > offsets[:-1]
+    lengths[has_rows] = hours[offsets[1:][has_rows] - 1] + 1
+    return lengths
+
+def to_3D_tensor_padded(df, max_hours=None, dtype=np.float32):
+    """
+    Like to_3D_tensor, for stays of any length: rows are sorted once by (stay, hours_in) and scattered into a
+    preallocated (stays x features x max_hours) array, at time index hours_in. Hours a stay doesn't have are 0.
+
+    df = (subject, hadm, icustay, hours_in) X features. Stays are in order of first appearance in df.
+    max_hours: time steps to keep; by default, up to the largest hours_in.
+
+    Returns:
+        X:       size[num_stays, num_features, max_hours]
+        lengths: size[num_stays], the last hours_in of each stay + 1 (at most max_hours)
+        mask:    size[num_stays, max_hours], True where the stay has a row for that hour
+        stays:   index of the stays, without hours_in
+    """
+    order, codes, hours, offsets, stays, max_hours = _sort_stay_rows(df, max_hours)
+
+    X = np.zeros((len(stays), df.shape[1], max_hours), dtype=dtype)
+    X[codes, :, hours] = df.values[order]
+    mask = np.zeros((len(stays), max_hours), dtype=bool)
+    mask[codes, hours] = True
+    return X, _stay_lengths(hours, offsets), mask, stays
+
+def last_observation_and_delta(X, Mask):
+    """
+    GRU-D's last observed values and time intervals, per stay, over size[num_stays, num_hours, num_vars] tensors.
+
+    X_last_obsv[s, t, d] is X at the latest hour <= t where Mask is 1, or X[s, t, d] itself if the variable
+    has not been measured yet in the stay.
+    Delta[s, t, d] is the time from the latest measurement strictly before t to t (Che et al. 2018, eq. 2),
+    or t if there is none; Delta[s, 0, d] = 0.
+    """
+    n, T, D = X.shape
+    t = np.arange(T, dtype=np.int64).reshape(1, T, 1)
+
+    # forward fill, as the running max over time of the hour of each measurement
+    last_obsv = np.maximum.accumulate(np.where(Mask > 0, t, -1), axis=1)
+    X_last_obsv = np.take_along_axis(X, np.maximum(last_obsv, 0), axis=1)
+    X_last_obsv = np.where(last_obsv >= 0, X_last_obsv, X)
+
+    last_before = np.full((n, T, D), -1, dtype=np.int64)
+    last_before[:, 1:, :] = last_obsv[:, :-1, :]
+    Delta = np.where(last_before >= 0, t - last_before, t)
+    return X_last_obsv.astype(np.float32), Delta.astype(np.float32)
+
+def split_grud_channels(X):
+    """
+    Splits a (stays x features x hours) tensor, with features ordered (mask, mean, time_since_measured) per
+    variable as the imputed frames are, into the GRU-D inputs, each size[num_stays, num_hours, num_vars]:
+        X:           the measurements
+        X_last_obsv: the last measured values (see last_observation_and_delta)
+        Mask:        1 where the variable was measured
+        Delta:       hours since the variable was last measured, recomputed per stay from Mask
+    """
+    transpose = lambda a: np.ascontiguousarray(a.transpose(0, 2, 1), dtype=np.float32)
+    X, Mask = transpose(X[:, 1::3, :]), transpose(X[:, 0::3, :])
+    X_last_obsv, Delta = last_observation_and_delta(X, Mask)
+    return X, X_last_obsv, Mask, Delta
+
+GRUD_CHANNELS = ('X', 'X_last_obsv', 'Mask', 'Delta')
+
+def save_tensor_store(df, Ys, out_dir, max_hours=None, stays_per_chunk=1000):
+    """
+    Writes df as a memory-mappable per-stay tensor store, for StayTensorDataset. The store is built
+    stays_per_chunk stays at a time, so the padded tensor never has to fit in memory.
+
+    out_dir gets:
+        X.npy, X_last_obsv.npy, Mask.npy, Delta.npy
+                     float32, size[num_stays, max_hours, num_vars], the split_grud_channels of the
+                     to_3D_tensor_padded tensor.
+        lengths.npy  int64, size[num_stays].
+        labels.npy   int64, size[num_stays], Ys aligned to the stays.
+        stays.npy    int64, size[num_stays, 3], the (subject, hadm, icustay) of each stay.
+        meta.json    num_stays, num_features, max_hours, the stay id columns and the feature columns.
+
+    df = (subject, hadm, icustay, hours_in) X features.
+    Ys = (subject, hadm, icustay) => label.
+    """
+    if not os.path.isdir(out_dir): os.makedirs(out_dir)
+
+    order, codes, hours, offsets, stays, max_hours = _sort_stay_rows(df, max_hours)
+    labels = Ys.reindex(stays)
+    assert labels.notnull().all(), "Ys is missing labels for %d stays" % labels.isnull().sum()
+
+    values = df.values
+    stores = [
+        np.lib.format.open_memmap(
+            os.path.join(out_dir, name + '.npy'), mode='w+', dtype=np.float32,
+            shape=(len(stays), max_hours, len(range(0, df.shape[1], 3)))
+        ) for name in GRUD_CHANNELS
+    ]
+    for start in range(0, len(stays), stays_per_chunk):
+        stop = min(start + stays_per_chunk, len(stays))
+        rows = slice(offsets[start], offsets[stop])
+        chunk = np.zeros((stop - start, df.shape[1], max_hours), dtype=np.float32)
+        chunk[codes[rows] - start, :, hours[rows]] = values[order[rows]]
+        for store, channel in zip(stores, split_grud_channels(chunk)): store[start:stop] = channel
+    for store in stores: store.flush()
+    del stores
+
+    np.save(os.path.join(out_dir, 'lengths.npy'), _stay_lengths(hours, offsets))
+    np.save(os.path.join(out_dir, 'labels.npy'), labels.values.astype(np.int64))
+    np.save(os.path.join(out_dir, 'stays.npy'), np.array(stays.tolist(), dtype=np.int64).reshape(len(stays), -1))
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'num_stays': len(stays), 'num_features': df.shape[1], 'max_hours': max_hours,
+            'stay_columns': [str(n) for n in stays.names],
+            'columns': [list(map(str, c)) if isinstance(c, tuple) else str(c) for c in df.columns],
+        }, f)
+
+class StayTensorDataset(utils.Dataset):
+    def __init__(self, store_dir):
+        """
+        Reads stays on demand from a store written by save_tensor_store. Items are
+        (X, X_last_obsv, Mask, Delta, label), as in the TensorDataset of prepare_dataloader, each
+        size[max_hours, num_vars].
+
+        The arrays are memory-mapped on first access, in whichever process does the reading, so each DataLoader
+        worker opens its own maps and resident memory stays proportional to the batches in flight.
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f: self.meta = json.load(f)
+        self.labels  = torch.from_numpy(np.load(os.path.join(store_dir, 'labels.npy')))
+        self.lengths = np.load(os.path.join(store_dir, 'lengths.npy'))
+        self._channels = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _open(self):
+        if self._channels is None:
+            self._channels = [
+                np.load(os.path.join(self.store_dir, name + '.npy'), mmap_mode='r') for name in GRUD_CHANNELS
+            ]
+        return self._channels
+
+    def __getitem__(self, i):
+        X, X_last_obsv, Mask, Delta = (torch.from_numpy(np.array(c[i])) for c in self._open())
+        return X, X_last_obsv, Mask, Delta, self.labels[i]
+
+    def batch(self, start, stop):
+        """ Stays start:stop as one batch, read with a single slice of each map. """
+        X, X_last_obsv, Mask, Delta = (torch.from_numpy(np.array(c[start:stop])) for c in self._open())
+        return X, X_last_obsv, Mask, Delta, self.labels[start:stop]
+
+    def icustay_ids(self):
+        stays = np.load(os.path.join(self.store_dir, 'stays.npy'))
+        columns = self.meta.get('stay_columns', [])
+        return stays[:, columns.index('icustay_id') if 'icustay_id' in columns else -1]
+
+    def __getstate__(self):
+        # Don't send open maps to DataLoader workers; each one maps the files itself.
+        state = self.__dict__.copy()
+        state['_channels'] = None
+        return state
+
 def prepare_dataloader(df, Ys, batch_size, shuffle=True):
     """
     dfs = (df_train, df_dev, df_test).
     df_* = (subject, hadm, icustay, hours_in) X (level2, agg fn \ni {mask, mean, time})
     Ys_series = (subject, hadm, icustay) => label.
+
+    Batches are (X, X_last_obsv, Mask, Delta, label), already split and laid out (batch, time, feature).
+    Labels are aligned to the stays of the tensor by index, so Ys may be in any order.
     """
-    X     = torch.from_numpy(to_3D_tensor(df).astype(np.float32))
-    label = torch.from_numpy(Ys.values.astype(np.int64))
-    dataset = utils.TensorDataset(X, label)
+    X, lengths, mask, stays = to_3D_tensor_padded(df)
+    labels = Ys.reindex(stays)
+    assert labels.notnull().all(), "Ys is missing labels for %d stays" % labels.isnull().sum()
+
+    channels = map(torch.from_numpy, split_grud_channels(X))
+    label = torch.from_numpy(labels.values.astype(np.int64))
+    dataset = utils.TensorDataset(*channels, label)
     
     return utils.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last = True)
 
+def prepare_store_dataloader(store_dir, batch_size, shuffle=True, num_workers=0, prefetch_factor=2):
+    """
+    Like prepare_dataloader, but streams batches from a tensor store (see save_tensor_store) instead of
+    holding the whole split in memory. With num_workers > 0, batches are read and prefetched in worker processes.
+    """
+    kwargs = {}
+    if num_workers > 0: kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': True}
+    return utils.DataLoader(
+        StayTensorDataset(store_dir), batch_size=batch_size, shuffle=shuffle, drop_last=True,
+        num_workers=num_workers, **kwargs
+    )
+
 class FilterLinear(nn.Module):
     def __init__(self, in_features, out_features, filter_square_matrix, bias=True):
         '''
@@ -63,8 +261,52 @@ class FilterLinear(nn.Module):
             + ', out_features=' + str(self.out_features) \
             + ', bias=' + str(self.bias is not None) + ')'
         
+def grud_sequence(
+    X, X_last_obsv, Mask, Delta, X_mean, gamma_x_weight, gamma_x_bias, gamma_h_weight, gamma_h_bias,
+    gates_weight, gates_bias, h, return_states: bool = False
+):
+    """
+    The GRUD.step recurrence over a whole sequence, written so it can be compiled with TorchScript
+    (see scripted_grud_sequence).
+
+    Inputs are size[batch, time, feature]; X_mean is size[time, feature]. gamma_x_weight is the diagonal of the
+    input decay, and gates_weight / gates_bias stack the update gate and candidate state linears, whose inputs
+    are (x, h, mask) as in GRUD.step. As in GRUD.step, the reset gate does not feed the candidate state, so it
+    is not computed. The decays and the x and mask parts of the gates do not depend on the hidden state, so
+    they are computed for every step at once; only h @ U is left in the loop.
+    """
+    input_size, hidden_size = X.size(2), h.size(1)
+
+    delta_x = torch.exp(-torch.clamp(Delta * gamma_x_weight + gamma_x_bias, min=0))
+    delta_h = torch.exp(-torch.clamp(torch.matmul(Delta, gamma_h_weight.t()) + gamma_h_bias, min=0))
+    X = Mask * X + (1 - Mask) * (delta_x * X_last_obsv + (1 - delta_x) * X_mean)
+
+    W_x, U, W_m = gates_weight.split([input_size, hidden_size, input_size], dim=1)
+    gates_xm = torch.matmul(X, W_x.t()) + torch.matmul(Mask, W_m.t()) + gates_bias
+    U_t = U.t()
+
+    # unbound once: indexing a step inside the loop would allocate a full-size gradient per step in backward
+    states = torch.jit.annotate(List[torch.Tensor], [])
+    for delta_h_i, gates_xm_i in zip(delta_h.unbind(1), gates_xm.unbind(1)):
+        h = delta_h_i * h
+        z, h_tilde = (gates_xm_i + torch.matmul(h, U_t)).chunk(2, dim=1)
+        z, h_tilde = torch.sigmoid(z), torch.tanh(h_tilde)
+        h = h + z * (h_tilde - h)
+        if return_states: states.append(h)
+
+    if return_states: return h, torch.stack(states, 1)
+    return h, h.new_empty(0)
+
+_scripted_grud_sequence = None
+
+def scripted_grud_sequence():
+    # scripted on first use, so importing this module doesn't pay for (or warn about) compilation
+    global _scripted_grud_sequence
+    if _scripted_grud_sequence is None: _scripted_grud_sequence = torch.jit.script(grud_sequence)
+    return _scripted_grud_sequence
+
 class GRUD(nn.Module):
-    def __init__(self, input_size, cell_size, hidden_size, X_mean, batch_size = 0, output_last = False):
+    def __init__(self, input_size, cell_size, hidden_size, X_mean, batch_size = 0, output_last = False, fused = False):
         """
         With minor modifications from https://github.com/zhiyongc/GRU-D/
 
@@ -89,6 +331,9 @@ class GRUD(nn.Module):
             hidden_size: dimension of hidden_state
             mask_size: dimension of masking vector
             X_mean: the mean of the historical input data
+            batch_size: unused; batches of any size are accepted
+            fused: run the recurrence with grud_sequence rather than step by step; 'script' runs the TorchScript
+                   compiled grud_sequence.
         """
         
         super(GRUD, self).__init__()
@@ -100,13 +345,9 @@ class GRUD(nn.Module):
         use_gpu = torch.cuda.is_available()
         if use_gpu:
             self.identity = torch.eye(input_size).cuda()
-            self.zeros = Variable(torch.zeros(batch_size, input_size).cuda())
-            self.zeros_h = Variable(torch.zeros(batch_size, self.hidden_size).cuda())
             self.X_mean = Variable(torch.Tensor(X_mean).cuda())
         else:
             self.identity = torch.eye(input_size)
-            self.zeros = Variable(torch.zeros(batch_size, input_size))
-            self.zeros_h = Variable(torch.zeros(batch_size, self.hidden_size))
             self.X_mean = Variable(torch.Tensor(X_mean))
         
         self.zl = nn.Linear(input_size + hidden_size + self.mask_size, hidden_size) # Wz, Uz are part of the same network. the bias is bz
@@ -118,6 +359,7 @@ class GRUD(nn.Module):
         self.gamma_h_l = nn.Linear(self.delta_size, self.hidden_size) # this was wrong in available version. remember to raise the issue
         
         self.output_last = output_last
+        self.fused = fused
         
         self.fc = nn.Linear(self.hidden_size, 2)
         self.bn= torch.nn.BatchNorm1d(2, eps=1e-05, momentum=0.1, affine=True)
@@ -141,12 +383,12 @@ class GRUD(nn.Module):
         dim_size = x.size()[1]
         
         gamma_x_l_delta = self.gamma_x_l(delta)
-        delta_x = torch.exp(-torch.max(self.zeros, gamma_x_l_delta)) #exponentiated negative rectifier
+        delta_x = torch.exp(-torch.clamp(gamma_x_l_delta, min=0)) #exponentiated negative rectifier
         
         gamma_h_l_delta = self.gamma_h_l(delta)
-        delta_h = torch.exp(-torch.max(self.zeros_h, gamma_h_l_delta)) #self.zeros became self.zeros_h to accomodate hidden size != input size
+        delta_h = torch.exp(-torch.clamp(gamma_h_l_delta, min=0)) #clamp rather than max with a zeros tensor, so any batch size works
         
-        x_mean = x_mean.repeat(batch_size, 1)
+        x_mean = x_mean.expand(batch_size, -1)
         
         x = mask * x + (1 - mask) * (delta_x * x_last_obsv + (1 - delta_x) * x_mean)
         h = delta_h * h
@@ -159,42 +401,45 @@ class GRUD(nn.Module):
         
         return h
     
-    def forward(self, X, X_last_obsv, Mask, Delta):
+    def forward(self, X, X_last_obsv, Mask, Delta, return_states=False):
+        """
+        Inputs are size[batch, time, feature]. Returns the classifier output for the last hidden state and,
+        if return_states, also the hidden state at every step, size[batch, time, hidden], in time order.
+        Intermediate states are not kept otherwise.
+        """
         batch_size = X.size(0)
-#         type_size = input.size(1)
         step_size = X.size(1) # num timepoints
-        spatial_size = X.size(2) # num features
         
+        assert self.X_mean.size(1) >= step_size, "X_mean has fewer time steps than the input"
         Hidden_State = self.initHidden(batch_size)
-#         X = torch.squeeze(input[:,0,:,:])
-#         X_last_obsv = torch.squeeze(input[:,1,:,:])
-#         Mask = torch.squeeze(input[:,2,:,:])
-#         Delta = torch.squeeze(input[:,3,:,:])
+
+        if self.fused:
+            sequence = scripted_grud_sequence() if self.fused == 'script' else grud_sequence
+            Hidden_State, outputs = sequence(
+                X, X_last_obsv, Mask, Delta, self.X_mean[0, :step_size],
+                torch.diagonal(self.gamma_x_l.filter_square_matrix * self.gamma_x_l.weight), self.gamma_x_l.bias,
+                self.gamma_h_l.weight, self.gamma_h_l.bias,
+                torch.cat((self.zl.weight, self.hl.weight), 0), torch.cat((self.zl.bias, self.hl.bias), 0),
+                Hidden_State, return_states,
+            )
+            prediction = self.drop(self.bn(self.fc(Hidden_State)))
+            if return_states: return prediction, outputs
+            return prediction
         
         outputs = None
-        for i in range(step_size):
-            Hidden_State = self.step(
-                torch.squeeze(X[:,i:i+1,:], 1),
-                torch.squeeze(X_last_obsv[:,i:i+1,:], 1),
-                torch.squeeze(self.X_mean[:,i:i+1,:], 1),
-                Hidden_State,
-                torch.squeeze(Mask[:,i:i+1,:], 1),
-                torch.squeeze(Delta[:,i:i+1,:], 1),
-            )
-            if outputs is None:
-                outputs = Hidden_State.unsqueeze(1)
-            else:
-                outputs = torch.cat((Hidden_State.unsqueeze(1), outputs), 1)
+        if return_states: outputs = X.new_empty(batch_size, step_size, self.hidden_size)
+
+        # per-step views, taken once rather than sliced and squeezed every step
+        steps = zip(X.unbind(1), X_last_obsv.unbind(1), self.X_mean[0, :step_size].unbind(0), Mask.unbind(1), Delta.unbind(1))
+        for i, (x, x_last_obsv, x_mean, mask, delta) in enumerate(steps):
+            Hidden_State = self.step(x, x_last_obsv, x_mean, Hidden_State, mask, delta)
+            if return_states: outputs[:, i] = Hidden_State
                 
         # we want to predict a binary outcome
         #Apply 50% dropout and batch norm here
-        self.drop(self.bn(self.fc(Hidden_State)))
-        return self.drop(self.bn(self.fc(Hidden_State)))
-                
-#         if self.output_last:
-#             return outputs[:,-1,:]
-#         else:
-#             return outputs
+        prediction = self.drop(self.bn(self.fc(Hidden_State)))
+        if return_states: return prediction, outputs
+        return prediction
     
     def initHidden(self, batch_size):
         use_gpu = torch.cuda.is_available()
@@ -253,26 +498,14 @@ def Train_Model(
         losses_epoch_train = []
         losses_epoch_valid = []
         
-        for X, labels in train_dataloader:
-            X = X.numpy()
-            mask        = torch.from_numpy(X[:, np.arange(0, X.shape[1], 3), :].astype(np.float32))
-            measurement = torch.from_numpy(X[:, np.arange(1, X.shape[1], 3), :].astype(np.float32))
-            time_       = torch.from_numpy(X[:, np.arange(2, X.shape[1], 3), :].astype(np.float32))
-            
-            mask = torch.transpose(mask, 1, 2)
-            measurement = torch.transpose(measurement, 1, 2)
-            time_ = torch.transpose(time_, 1, 2)
-            measurement_last_obsv = measurement            
-
+        for measurement, measurement_last_obsv, mask, time_, labels in train_dataloader:
             assert measurement.size()[0] == batch_size, "Batch Size doesn't match! %s" % str(measurement.size())
 
             if use_gpu:
                 convert_to_cuda=lambda x: Variable(x.cuda())
                 X, X_last_obsv, Mask, Delta, labels = map(convert_to_cuda, [measurement, measurement_last_obsv, mask, time_, labels])
             else: 
-#                 inputs, labels = Variable(inputs), Variable(labels)
-                convert_to_tensor=lambda x: Variable(x)
-                X, X_last_obsv, Mask, Delta, labels  = map(convert_to_tensor, [measurement, measurement_last_obsv, mask, time_, labels])
+                X, X_last_obsv, Mask, Delta, labels = measurement, measurement_last_obsv, mask, time_, labels
             
             model.zero_grad()
 
@@ -301,36 +534,17 @@ def Train_Model(
             
              # validation 
             try: 
-                X_val, labels_val = next(valid_dataloader_iter)
-                X_val = X_val.numpy()
-                mask_val        = torch.from_numpy(X_val[:, np.arange(0, X_val.shape[1], 3), :].astype(np.float32))
-                measurement_val = torch.from_numpy(X_val[:, np.arange(1, X_val.shape[1], 3), :].astype(np.float32))
-                time_val       = torch.from_numpy(X_val[:, np.arange(2, X_val.shape[1], 3), :].astype(np.float32))
-            
-                mask_val = torch.transpose(mask_val, 1, 2)
-                measurement_val = torch.transpose(measurement_val, 1, 2)
-                time_val = torch.transpose(time_val, 1, 2)
-                measurement_last_obsv_val = measurement_val
+                batch_val = next(valid_dataloader_iter)
             except StopIteration:
                 valid_dataloader_iter = iter(valid_dataloader)
-                X_val, labels_val = next(valid_dataloader_iter)
-                X_val = X_val.numpy()
-                mask_val        = torch.from_numpy(X_val[:, np.arange(0, X_val.shape[1], 3), :].astype(np.float32))
-                measurement_val = torch.from_numpy(X_val[:, np.arange(1, X_val.shape[1], 3), :].astype(np.float32))
-                time_val       = torch.from_numpy(X_val[:, np.arange(2, X_val.shape[1], 3), :].astype(np.float32))
-            
-                mask_val = torch.transpose(mask_val, 1, 2)
-                measurement_val = torch.transpose(measurement_val, 1, 2)
-                time_val = torch.transpose(time_val, 1, 2)
-                measurement_last_obsv_val = measurement_val
+                batch_val = next(valid_dataloader_iter)
+            measurement_val, measurement_last_obsv_val, mask_val, time_val, labels_val = batch_val
             
             if use_gpu:
                 convert_to_cuda=lambda x: Variable(x.cuda())
                 X_val, X_last_obsv_val, Mask_val, Delta_val, labels_val = map(convert_to_cuda, [measurement_val, measurement_last_obsv_val, mask_val, time_val, labels_val])
             else: 
-#                 inputs, labels = Variable(inputs), Variable(labels)
-                convert_to_tensor=lambda x: Variable(x)
-                X_val, X_last_obsv_val, Mask_val, Delta_val, labels_val = map(convert_to_tensor, [measurement_val, measurement_last_obsv_val, mask_val, time_val, labels_val])
+                X_val, X_last_obsv_val, Mask_val, Delta_val, labels_val = measurement_val, measurement_last_obsv_val, mask_val, time_val, labels_val
             
                 
             model.zero_grad()
@@ -400,7 +614,7 @@ def predict_proba(model, dataloader):
     """
     Input:
         model: GRU-D model
-        test_dataloader: containing batches of measurement, measurement_last_obsv, mask, time_, labels
+        dataloader: containing batches of measurement, measurement_last_obsv, mask, time_, labels
     Returns:
         predictions: size[num_samples, 2]
         labels: size[num_samples]
@@ -410,31 +624,100 @@ def predict_proba(model, dataloader):
     
     probabilities = []
     labels        = []
-    ethnicities   = []
-    genders       = []
-    for X, label in dataloader:
-        X = X.numpy()
-        mask        = torch.from_numpy(X[:, np.arange(0, X.shape[1], 3), :].astype(np.float32))
-        measurement = torch.from_numpy(X[:, np.arange(1, X.shape[1], 3), :].astype(np.float32))
-        time_       = torch.from_numpy(X[:, np.arange(2, X.shape[1], 3), :].astype(np.float32))
-
-        mask = torch.transpose(mask, 1, 2)
-        measurement = torch.transpose(measurement, 1, 2)
-        time_ = torch.transpose(time_, 1, 2)
-        measurement_last_obsv = measurement            
+    with inference_mode():
+        for measurement, measurement_last_obsv, mask, time_, label in dataloader:
+            if use_gpu:
+                convert_to_cuda=lambda x: Variable(x.cuda())
+                X, X_last_obsv, Mask, Delta, label = map(convert_to_cuda, [measurement, measurement_last_obsv, mask, time_, label])
+            else: 
+                X, X_last_obsv, Mask, Delta, label = measurement, measurement_last_obsv, mask, time_, label
 
-        if use_gpu:
-            convert_to_cuda=lambda x: Variable(x.cuda())
-            X, X_last_obsv, Mask, Delta, label = map(convert_to_cuda, [measurement, measurement_last_obsv, mask, time_, label])
-        else: 
-#                 inputs, labels = Variable(inputs), Variable(labels)
-            convert_to_tensor=lambda x: Variable(x)
-            X, X_last_obsv, Mask, Delta, label  = map(convert_to_tensor, [measurement, measurement_last_obsv, mask, time_, label])
+            prob = model(X, X_last_obsv, Mask, Delta)
+            
+            probabilities.append(prob.cpu().numpy())
+            labels.append(label.cpu().numpy())
 
-        
-        prob = model(X, X_last_obsv, Mask, Delta)
-        
-        probabilities.append(prob.detach().cpu().data.numpy())
-        labels.append(label.detach().cpu().data.numpy())
+    return probabilities, labels
+
+def inference_mode():
+    # torch.inference_mode is only in torch >= 1.9
+    return torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+
+PREDICTION_COLUMNS = ['icustay_id', 'label', 'score', 'prob']
+
+def _write_predictions(model, dataset, icustay_ids, f, start, stop, batch_size):
+    with inference_mode():
+        for a in range(start, stop, batch_size):
+            b = min(a + batch_size, stop)
+            X, X_last_obsv, Mask, Delta, label = dataset.batch(a, b)
+            output = model(X, X_last_obsv, Mask, Delta)
+            pd.DataFrame({
+                'icustay_id': icustay_ids[a:b], 'label': label.numpy(),
+                'score': output[:, 1].numpy(), 'prob': torch.softmax(output, 1)[:, 1].numpy(),
+            }, columns=PREDICTION_COLUMNS).to_csv(f, header=False, index=False)
+
+_worker_model = None
+
+def _init_predict_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def _predict_shard(store_dir, out_path, start, stop, batch_size, threads, cores):
+    if cores is not None and hasattr(os, 'sched_setaffinity'): os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    dataset = StayTensorDataset(store_dir)
+    with open(out_path, 'w') as f:
+        _write_predictions(_worker_model, dataset, dataset.icustay_ids(), f, start, stop, batch_size)
+    return out_path
+
+def predict_to_csv(model, store_dir, out_path, batch_size=4096, n_jobs=1, threads_per_job=None):
+    """
+    Scores every stay of a tensor store (see save_tensor_store) and streams the predictions to a CSV, one row
+    per stay in store order, with columns icustay_id, label, score (the model output predict_proba reports) and
+    prob (its softmax). Batches are read, scored and written one at a time under inference mode, so memory use
+    does not grow with the cohort, and unlike the training dataloaders no stays are dropped.
+
+    n_jobs: number of processes; each scores a contiguous shard of the stays into its own part file, which
+            are then concatenated in order. Each process is pinned to its own threads_per_job cores (all cores
+            split evenly between processes by default), where the OS allows it.
+
+    Returns:
+        number of stays scored
+    """
+    model.eval()
+    dataset = StayTensorDataset(store_dir)
+    n_stays = len(dataset)
+
+    if n_jobs == 1:
+        with open(out_path, 'w') as f:
+            f.write(','.join(PREDICTION_COLUMNS) + '\n')
+            _write_predictions(model, dataset, dataset.icustay_ids(), f, 0, n_stays, batch_size)
+        return n_stays
+
+    if n_jobs is None or n_jobs < 1: n_jobs = multiprocessing.cpu_count()
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(multiprocessing.cpu_count()))
+    if threads_per_job is None: threads_per_job = max(1, len(cores) // n_jobs)
+    core_sets = [cores[i * threads_per_job:(i + 1) * threads_per_job] for i in range(n_jobs)]
+    # don't pin if there aren't enough cores for every process to have its own
+    if len(core_sets[-1]) < threads_per_job: core_sets = [None] * n_jobs
+
+    bounds = np.linspace(0, n_stays, n_jobs + 1).astype(int)
+    parts = ['%s.part%03d' % (out_path, i) for i in range(n_jobs)]
+
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_predict_worker, initargs=(model,))
+    try:
+        results = [
+            pool.apply_async(_predict_shard, (store_dir, parts[i], bounds[i], bounds[i + 1], batch_size, threads_per_job, core_sets[i]))
+            for i in range(n_jobs)
+        ]
+        for r in results: r.get()
+    finally:
+        pool.close()
+        pool.join()
 
-    return probabilities, labels
\ No newline at end of file
+    with open(out_path, 'w') as f:
+        f.write(','.join(PREDICTION_COLUMNS) + '\n')
+        for part in parts:
+            with open(part) as p: shutil.copyfileobj(p, f)
+            os.remove(part)
+    return n_stays
\ No newline at end of file
@@ -0,0 +1,283 @@
+import array, collections, json, os, re, numpy as np, pandas as pd
+
+ID_COLS = ['subject_id', 'hadm_id', 'icustay_id']
+
+PAD_TOKEN, UNK_TOKEN = '<pad>', '<unk>'
+
+# De-identification placeholders (e.g. [**Hospital 1234**]) are kept as single tokens, as in save_notes.
+TOKEN_REGEX = re.compile(r"\[\*\*.*?\*\*\]|\w+|[^\w\s]", flags=re.UNICODE)
+
+def tokenize_note_text(text, lower=True):
+    """ Tokenize processed note text (one sentence per line, as produced by save_notes).
+
+    Returns
+    -------
+    sentences : list of list of str
+    """
+    if not isinstance(text, str): return []
+    if lower: text = text.lower()
+
+    sentences = []
+    for line in text.split('\n'):
+        tokens = TOKEN_REGEX.findall(line)
+        if tokens: sentences.append(tokens)
+    return sentences
+
+def build_note_vocab(texts, min_count=1, max_size=None, lower=True):
+    """ Build a token vocabulary over processed note texts.
+
+    Returns
+    -------
+    vocab : list of str
+        vocab[0] is the padding token and vocab[1] the unknown token; the rest are ordered by decreasing count.
+    """
+    counts = collections.Counter()
+    for text in texts:
+        for sentence in tokenize_note_text(text, lower=lower): counts.update(sentence)
+    return _vocab_from_counts(counts, min_count=min_count, max_size=max_size)
+
+def _vocab_from_counts(counts, min_count=1, max_size=None):
+    tokens = sorted((t for t, c in counts.items() if c >= min_count), key=lambda t: (-counts[t], t))
+    if max_size is not None: tokens = tokens[:max(0, max_size - 2)]
+    return [PAD_TOKEN, UNK_TOKEN] + tokens
+
+def note_hours_in(notes, data):
+    """ Hours since ICU intime for each note, with the same flooring as the hourly vitals_labs grid.
+
+    Args
+    ----
+    notes : pd.DataFrame
+        Must have icustay_id and charttime as columns or index levels.
+    data : pd.DataFrame
+        Static data with icustay_id (column or index level), intime and outtime.
+
+    Returns
+    -------
+    hours_in : np.ndarray of float, aligned to the rows of notes.
+        NaN where the note has no charttime or its stay is not in data.
+    max_hours : np.ndarray of float, aligned to the rows of notes.
+        The last hour of the note's ICU stay on the grid (NaN where the stay is not in data).
+    """
+    stays = data.reset_index().drop_duplicates('icustay_id').set_index('icustay_id')
+    intime, outtime = pd.to_datetime(stays['intime']), pd.to_datetime(stays['outtime'])
+    max_hours = ((outtime - intime) // pd.Timedelta(hours=1)).clip(lower=0)
+
+    icustay_ids = np.asarray(notes.index.get_level_values('icustay_id') if 'icustay_id' in notes.index.names
+                             else notes['icustay_id'])
+    charttime = pd.to_datetime(np.asarray(notes.index.get_level_values('charttime') if 'charttime' in notes.index.names
+                                          else notes['charttime']))
+
+    note_intime = pd.DatetimeIndex(intime.reindex(icustay_ids).values)
+    hours_in = ((charttime - note_intime) // pd.Timedelta(hours=1)).values.astype(float)
+    hours_in = np.where(np.isnan(hours_in), np.nan, np.maximum(hours_in, 0))
+
+    return hours_in, max_hours.reindex(icustay_ids).values.astype(float)
+
+def sort_notes(notes):
+    """ Notes in their canonical order, by (icustay_id, charttime). A note's id is its position in this order,
+    in both save_note_tensors and build_hourly_note_index.
+
+    Returns
+    -------
+    notes : pd.DataFrame, flat (index reset), with charttime parsed and a note_id column.
+    """
+    notes = notes.reset_index()
+    notes['charttime'] = pd.to_datetime(notes['charttime'])
+    notes = notes.sort_values(['icustay_id', 'charttime'], kind='mergesort').reset_index(drop=True)
+    notes['note_id'] = np.arange(len(notes), dtype=np.int64)
+    return notes
+
+def save_note_tensors(
+    notes, out_dir, data=None, vocab=None, min_count=5, max_vocab_size=None, lower=True, notes_per_chunk=1000
+):
+    """ Write notes as memory-mappable ragged token-id arrays.
+
+    Notes are ordered by sort_notes and written to out_dir as:
+        vocab.txt          one token per line; line i is token id i.
+        tokens.npy         int32, all token ids, concatenated.
+        sent_offsets.npy   int64, n_sentences + 1; sentence i is tokens[sent_offsets[i]:sent_offsets[i+1]].
+        note_offsets.npy   int64, n_notes + 1; note j is sentences note_offsets[j] to note_offsets[j+1].
+        stay_ids.npy       int64, the distinct icustay_ids, sorted.
+        stay_offsets.npy   int64, n_stays + 1; stay k is notes stay_offsets[k] to stay_offsets[k+1].
+        index.csv          one row per note: note_id, ID_COLS, charttime, category, description and hours_in
+                           (-1 if the note could not be aligned to the hourly grid, e.g. it was charted after
+                           outtime, or data was not given), as in build_hourly_note_index.
+
+    Each note is tokenized once. Token ids are written notes_per_chunk notes at a time, as int32, so the
+    corpus is never held as Python objects: first as ids in order of first occurrence, to a temporary file, then
+    remapped to vocabulary ids once the vocabulary is known.
+
+    Args
+    ----
+    notes : pd.DataFrame
+        Output of save_notes.
+    data : pd.DataFrame or None
+        Static data, used to align notes to hours_in via charttime.
+    vocab : list of str or None
+        Reuse an existing vocabulary (e.g. the training one); built from these notes if None.
+
+    Returns
+    -------
+    vocab : list of str
+    """
+    if not os.path.isdir(out_dir): os.makedirs(out_dir)
+
+    notes = sort_notes(notes)
+
+    # pass 1: tokenize, numbering distinct tokens by first occurrence and counting them
+    seen_ids, seen_counts = {}, []
+    sent_lengths, note_lengths, n_tokens = [], [], 0
+    seen_path = os.path.join(out_dir, 'tokens.seen.tmp')
+    with open(seen_path, 'wb') as f:
+        for start in range(0, len(notes), notes_per_chunk):
+            chunk_ids, chunk_sent_lengths, chunk_note_lengths = array.array('i'), [], []
+            for text in notes['text'].values[start:start + notes_per_chunk]:
+                sentences = tokenize_note_text(text, lower=lower)
+                for sentence in sentences:
+                    for t in sentence:
+                        i = seen_ids.get(t)
+                        if i is None:
+                            i = seen_ids[t] = len(seen_counts)
+                            seen_counts.append(0)
+                        seen_counts[i] += 1
+                        chunk_ids.append(i)
+                    chunk_sent_lengths.append(len(sentence))
+                chunk_note_lengths.append(len(sentences))
+            np.frombuffer(chunk_ids, dtype=np.int32).tofile(f)
+            sent_lengths.append(np.asarray(chunk_sent_lengths, dtype=np.int64))
+            note_lengths.append(np.asarray(chunk_note_lengths, dtype=np.int64))
+            n_tokens += len(chunk_ids)
+
+    if vocab is None:
+        vocab = _vocab_from_counts(dict(zip(seen_ids, seen_counts)), min_count=min_count, max_size=max_vocab_size)
+    token_ids = {t: i for i, t in enumerate(vocab)}
+    unk_id = token_ids[UNK_TOKEN]
+    remap = np.full(len(seen_counts), unk_id, dtype=np.int32)
+    for t, i in seen_ids.items(): remap[i] = token_ids.get(t, unk_id)
+
+    # pass 2: first-occurrence ids to vocabulary ids, chunk by chunk
+    tokens = np.lib.format.open_memmap(os.path.join(out_dir, 'tokens.npy'), mode='w+', dtype=np.int32, shape=(n_tokens,))
+    if n_tokens > 0:
+        seen = np.memmap(seen_path, dtype=np.int32, mode='r', shape=(n_tokens,))
+        tokens_per_chunk = 2**24
+        for start in range(0, n_tokens, tokens_per_chunk):
+            tokens[start:start + tokens_per_chunk] = remap[seen[start:start + tokens_per_chunk]]
+        del seen
+    tokens.flush()
+    del tokens
+    os.remove(seen_path)
+
+    concat = lambda chunks: np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+    sent_lengths, note_lengths = concat(sent_lengths), concat(note_lengths)
+    offsets = lambda lengths: np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+    stay_ids, stay_starts = np.unique(notes['icustay_id'].values.astype(np.int64), return_index=True)
+    stay_offsets = np.append(stay_starts, len(notes)).astype(np.int64)
+
+    np.save(os.path.join(out_dir, 'sent_offsets.npy'), offsets(sent_lengths))
+    np.save(os.path.join(out_dir, 'note_offsets.npy'), offsets(note_lengths))
+    np.save(os.path.join(out_dir, 'stay_ids.npy'), stay_ids)
+    np.save(os.path.join(out_dir, 'stay_offsets.npy'), stay_offsets)
+    with open(os.path.join(out_dir, 'vocab.txt'), 'w') as f: f.write('\n'.join(vocab))
+
+    index = notes[[c for c in ['note_id'] + ID_COLS + ['charttime', 'category', 'description'] if c in notes.columns]].copy()
+    index['hours_in'] = -1
+    if data is not None:
+        hours_in, max_hours = note_hours_in(notes, data)
+        # same rule as build_hourly_note_index: notes past the end of the stay's grid are not aligned
+        on_grid = ~np.isnan(hours_in) & (hours_in <= max_hours)
+        index['hours_in'] = np.where(on_grid, hours_in, -1).astype(int)
+    index.to_csv(os.path.join(out_dir, 'index.csv'), index=False)
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'n_notes': len(notes), 'n_sentences': len(sent_lengths), 'n_tokens': n_tokens,
+                   'vocab_size': len(vocab), 'lower': lower}, f)
+
+    print("Saved %d notes / %d sentences / %d tokens (vocab size %d) to %s" % (
+        len(notes), len(sent_lengths), n_tokens, len(vocab), out_dir
+    ))
+    return vocab
+
+def load_note_tensors(out_dir, mmap_mode='r'):
+    """ Load the output of save_note_tensors; arrays are memory-mapped unless mmap_mode is None.
+
+    Returns
+    -------
+    tensors : dict
+        vocab, tokens, sent_offsets, note_offsets, stay_ids, stay_offsets and index (pd.DataFrame).
+    """
+    tensors = {
+        k: np.load(os.path.join(out_dir, k + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+        for k in ('tokens', 'sent_offsets', 'note_offsets', 'stay_ids', 'stay_offsets')
+    }
+    with open(os.path.join(out_dir, 'vocab.txt')) as f: tensors['vocab'] = f.read().split('\n')
+    tensors['index'] = pd.read_csv(os.path.join(out_dir, 'index.csv'), parse_dates=['charttime'])
+    return tensors
+
+def get_note_tokens(tensors, note_idx):
+    """ The sentences of note note_idx, as a list of int32 token-id arrays (views into tensors['tokens']). """
+    sent_offsets, note_offsets = tensors['sent_offsets'], tensors['note_offsets']
+    s_start, s_end = note_offsets[note_idx], note_offsets[note_idx + 1]
+    return [tensors['tokens'][sent_offsets[s]:sent_offsets[s + 1]] for s in range(s_start, s_end)]
+
+def build_hourly_note_index(notes, data):
+    """ Bin notes into the (subject_id, hadm_id, icustay_id, hours_in) grid used for vitals_labs.
+
+    Notes without a charttime, or charted outside of their ICU stay's grid, are left out.
+
+    Args
+    ----
+    notes : pd.DataFrame
+        Output of save_notes. Note ids are as in sort_notes, so they index note_offsets of save_note_tensors.
+    data : pd.DataFrame
+        Static data with icustay_id (column or index level), intime and outtime.
+
+    Returns
+    -------
+    notes_hourly : pd.DataFrame
+        index = ID_COLS + ['hours_in'], only for hours with at least one note.
+        Columns note_start and note_stop, such that the notes charted in that hour are
+        note_ids[note_start:note_stop], in charttime order.
+    note_ids : pd.Series of int64
+    """
+    flat = sort_notes(notes)
+    flat['hours_in'], max_hours = note_hours_in(flat, data)
+    flat = flat.loc[flat['hours_in'].notnull().values & (flat['hours_in'].values <= max_hours)]
+    flat['hours_in'] = flat['hours_in'].astype(int)
+    flat = flat.sort_values(ID_COLS + ['hours_in', 'charttime'], kind='mergesort')
+
+    note_ids = flat['note_id'].reset_index(drop=True)
+
+    keys = flat[ID_COLS + ['hours_in']].values
+    is_start = np.ones(len(keys), dtype=bool)
+    if len(keys) > 1: is_start[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+    starts = np.flatnonzero(is_start)
+
+    notes_hourly = pd.DataFrame(
+        {'note_start': starts, 'note_stop': np.append(starts[1:], len(keys))},
+        index=pd.MultiIndex.from_arrays([keys[starts, i] for i in range(keys.shape[1])], names=ID_COLS + ['hours_in']),
+    )
+    return notes_hourly, note_ids
+
+def hourly_note_offsets(notes_hourly, index):
+    """ Align build_hourly_note_index output to the rows of an hourly frame (e.g. vitals_labs).
+
+    Returns
+    -------
+    order : np.ndarray of int64
+    offsets : np.ndarray of int64, len(index) + 1
+        The notes of row i of index are note_ids.values[order[offsets[i]:offsets[i+1]]].
+    """
+    rows = index.get_indexer(notes_hourly.index.reorder_levels(index.names))
+    keep = rows >= 0
+    rows, starts, stops = rows[keep], notes_hourly['note_start'].values[keep], notes_hourly['note_stop'].values[keep]
+
+    counts = np.zeros(len(index), dtype=np.int64)
+    counts[rows] = stops - starts
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    group_order = np.argsort(rows, kind='mergesort')
+    lengths = (stops - starts)[group_order]
+    order = np.repeat(starts[group_order] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    order += np.arange(len(order), dtype=np.int64)
+    return order.astype(np.int64), offsets
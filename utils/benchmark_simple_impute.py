@@ -0,0 +1,101 @@
+""" Compare the imputers in simple_impute on a synthetic cohort shaped like all_hourly_data's vitals_labs.
+
+Usage: python benchmark_simple_impute.py [--n_stays 2000] [--n_hours 48] [--n_vars 100] [--n_jobs 4]
+"""
+import argparse, os, tempfile, time, numpy as np, pandas as pd
+from pandas.testing import assert_frame_equal
+
+from simple_impute import (
+    ID_COLS, SimpleImputer, iter_stay_partitions, simple_imputer, vectorized_simple_imputer, write_stay_partitions
+)
+
+def make_synthetic_cohort(n_stays=2000, n_hours=48, n_vars=100, missing_rate=0.9, seed=0):
+    """ Hourly (subject_id, hadm_id, icustay_id, hours_in) x (LEVEL2, mean/count/std) frame, with stays of
+    random length up to n_hours and missing_rate of the (hour, variable) cells unobserved. """
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(1, n_hours + 1, size=n_stays)
+    stay = np.repeat(np.arange(n_stays), lengths)
+    hours_in = np.concatenate([np.arange(l) for l in lengths])
+    index = pd.MultiIndex.from_arrays(
+        [stay + 1, stay + 100000, stay + 200000, hours_in], names=ID_COLS + ['hours_in']
+    )
+
+    n_rows = len(stay)
+    observed = rng.rand(n_rows, n_vars) > missing_rate
+    means = np.where(observed, rng.randn(n_rows, n_vars) + np.arange(n_vars)[None, :], np.nan)
+    counts = np.where(observed, rng.randint(1, 4, size=(n_rows, n_vars)), 0).astype(float)
+    stds = np.where(observed, rng.rand(n_rows, n_vars), np.nan)
+
+    level2 = ['var_%03d' % i for i in range(n_vars)]
+    frames = [
+        pd.DataFrame(v, index=index, columns=pd.MultiIndex.from_product(
+            [level2, [agg]], names=['LEVEL2', 'Aggregation Function']
+        )) for agg, v in (('count', counts), ('mean', means), ('std', stds))
+    ]
+    return pd.concat(frames, axis=1).sort_index(axis=1)
+
+def time_it(fn, *args, **kwargs):
+    start = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - start
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--n_stays', type=int, default=2000)
+    ap.add_argument('--n_hours', type=int, default=48)
+    ap.add_argument('--n_vars', type=int, default=100)
+    ap.add_argument('--missing_rate', type=float, default=0.9)
+    ap.add_argument('--n_jobs', type=int, default=0, help="Also time transform_hdf with this many processes.")
+    ap.add_argument('--stays_per_partition', type=int, default=250)
+    args = ap.parse_args()
+
+    df = make_synthetic_cohort(args.n_stays, args.n_hours, args.n_vars, args.missing_rate)
+    train_subj = list(df.index.get_level_values('subject_id').unique()[: args.n_stays // 2])
+    print("Synthetic cohort: %d rows x %d columns" % df.shape)
+
+    idx = pd.IndexSlice
+    reference, t_reference = time_it(simple_imputer, df, train_subj)
+    vectorized, t_vectorized = time_it(vectorized_simple_imputer, df, train_subj)
+    print("simple_imputer:            %.3f sec" % t_reference)
+    print("vectorized_simple_imputer: %.3f sec (%.1fx)" % (t_vectorized, t_reference / t_vectorized))
+
+    for agg in ('mean', 'mask'):
+        np.testing.assert_allclose(
+            vectorized.loc[:, idx[:, agg]].values, reference.loc[:, idx[:, agg]].values, err_msg=agg
+        )
+    # simple_imputer's time_since_measured carries over between stays, so compare against a per-stay version.
+    mask = reference.loc[:, idx[:, 'mask']]
+    is_absent = 1 - mask
+    hours_of_absence = is_absent.groupby(ID_COLS).cumsum()
+    expected = (hours_of_absence - hours_of_absence[is_absent == 0].groupby(ID_COLS).ffill()).fillna(100)
+    np.testing.assert_allclose(vectorized.loc[:, idx[:, 'time_since_measured']].values, expected.values)
+    print("Outputs match.")
+
+    # re-running into the same keys with fewer partitions must not leave the earlier run's extra partitions
+    imputer = SimpleImputer().fit(df, train_subj)
+    tmp_dir = tempfile.mkdtemp()
+    in_path, out_path = os.path.join(tmp_dir, 'in.h5'), os.path.join(tmp_dir, 'out.h5')
+    for stays_per_partition in (args.n_stays // 10, args.n_stays // 2):
+        write_stay_partitions(df, in_path, 'vitals_labs', stays_per_partition)
+        imputer.transform_hdf(in_path, 'vitals_labs', out_path, 'imputed', stays_per_partition=stays_per_partition)
+        imputer.transform_hdf(in_path, 'vitals_labs', out_path, 'imputed_parallel', n_jobs=2)
+    assert_frame_equal(pd.concat(iter_stay_partitions(in_path, 'vitals_labs')), df)
+    for key in ('imputed', 'imputed_parallel'):
+        np.testing.assert_allclose(pd.concat(iter_stay_partitions(out_path, key)).values, vectorized.values, err_msg=key)
+    print("Re-written partitions match.")
+
+    if args.n_jobs:
+        imputer = SimpleImputer().fit(df, train_subj)
+        tmp_dir = tempfile.mkdtemp()
+        in_path, out_path = os.path.join(tmp_dir, 'in.h5'), os.path.join(tmp_dir, 'out.h5')
+        write_stay_partitions(df, in_path, 'vitals_labs', args.stays_per_partition)
+
+        _, t_serial = time_it(imputer.transform_hdf, in_path, 'vitals_labs', out_path, 'serial')
+        _, t_parallel = time_it(
+            imputer.transform_hdf, in_path, 'vitals_labs', out_path, 'parallel', n_jobs=args.n_jobs
+        )
+        print("transform_hdf, 1 process:   %.3f sec" % t_serial)
+        print("transform_hdf, %d processes: %.3f sec (%.1fx)" % (args.n_jobs, t_parallel, t_serial / t_parallel))
+
+        np.testing.assert_allclose(pd.concat(iter_stay_partitions(out_path, 'parallel')).values, vectorized.values)
+        print("Parallel output matches.")
@@ -1,4 +1,4 @@
-import copy, math, os, pickle, time, pandas as pd, numpy as np
+import collections, copy, json, math, multiprocessing, os, pickle, time, pandas as pd, numpy as np
 
 ID_COLS = ['subject_id', 'hadm_id', 'icustay_id']
 
@@ -26,4 +26,322 @@ def simple_imputer(df,train_subj):
     df_out.loc[:, idx[:, 'time_since_measured']] = df_out.loc[:, idx[:, 'time_since_measured']].fillna(100)
     
     df_out.sort_index(axis=1, inplace=True)
-    return df_out
\ No newline at end of file
+    return df_out
+
+def stay_offsets(index, level='icustay_id'):
+    """ Row offsets of each stay's contiguous block in an hourly index.
+
+    Returns
+    -------
+    offsets : np.ndarray of int64, n_stays + 1
+        Stay k covers rows offsets[k]:offsets[k+1]. If the index is not grouped by stay, a stay split into
+        several blocks counts once per block.
+    """
+    ids = index.get_level_values(level).values
+    is_start = np.ones(len(ids), dtype=bool)
+    if len(ids) > 1: is_start[1:] = ids[1:] != ids[:-1]
+    return np.append(np.flatnonzero(is_start), len(ids)).astype(np.int64)
+
+def last_observed_positions(observed, offsets):
+    """ For each row and column, the row of the latest observation at or before it in the same stay (-1 if none).
+
+    Args
+    ----
+    observed : np.ndarray of bool, (n_rows, n_cols)
+    offsets : np.ndarray of int64, from stay_offsets.
+    """
+    n = observed.shape[0]
+    pos = np.where(observed, np.arange(n, dtype=np.int64)[:, None], -1)
+    np.maximum.accumulate(pos, axis=0, out=pos)
+    row_start = np.repeat(offsets[:-1], np.diff(offsets))
+    pos[pos < row_start[:, None]] = -1
+    return pos
+
+def simple_imputer_global_means(df, train_subj):
+    """ The global means simple_imputer fills with: per-column means over the rows of the training subjects. """
+    idx = pd.IndexSlice
+    means = df.loc[:, idx[:, 'mean']]
+    is_train = means.index.get_level_values('subject_id').isin(set(train_subj))
+    return means.loc[is_train].mean(axis=0)
+
+def vectorized_simple_imputer(df, train_subj=None, global_means=None, fill_time_since_measured=100):
+    """ simple_imputer, computed in one pass over contiguous per-stay NumPy blocks.
+
+    Produces the same mean and mask columns as simple_imputer. time_since_measured differs in that it restarts at
+    each stay: hours before a stay's first measurement are set to fill_time_since_measured, rather than counting
+    from a measurement in the previous stay.
+
+    Args
+    ----
+    df : pd.DataFrame
+        index = ID_COLS + ['hours_in'], columns = (..., Aggregation Function) with 'mean' and 'count' present.
+    train_subj : list-like or None
+        Subjects whose rows define the global means. Ignored if global_means is given.
+    global_means : pd.Series or None
+        Precomputed global means, indexed like df.loc[:, idx[:, 'mean']].columns.
+
+    Returns
+    -------
+    df_out : pd.DataFrame
+        Same index as df (sorted by stay if it was not already grouped), columns (..., mask / mean /
+        time_since_measured), sorted.
+    """
+    idx = pd.IndexSlice
+    if global_means is None: global_means = simple_imputer_global_means(df, train_subj)
+
+    offsets = stay_offsets(df.index)
+    if len(set(df.index.get_level_values('icustay_id')[offsets[:-1]])) != len(offsets) - 1:
+        df = df.sort_index()
+        offsets = stay_offsets(df.index)
+    lengths = np.diff(offsets)
+
+    mean_df = df.loc[:, idx[:, 'mean']]
+    prefixes = [c[:-1] for c in mean_df.columns]
+    means = mean_df.values.astype(np.float64)
+    counts = df.loc[:, [p + ('count',) for p in prefixes]].values
+    n_rows, n_cols = means.shape
+
+    # Forward fill within stays
+    has_value = ~np.isnan(means)
+    pos = last_observed_positions(has_value, offsets)
+    filled = np.where(pos >= 0, means[np.maximum(pos, 0), np.arange(n_cols)[None, :]], np.nan)
+
+    # Then stay means, then global means
+    if n_rows > 0:
+        stay_sums = np.add.reduceat(np.where(has_value, means, 0.0), offsets[:-1], axis=0)
+        stay_counts = np.add.reduceat(has_value.astype(np.int64), offsets[:-1], axis=0)
+    else:
+        stay_sums, stay_counts = np.zeros((0, n_cols)), np.zeros((0, n_cols), dtype=np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stay_means = np.where(stay_counts > 0, stay_sums / np.maximum(stay_counts, 1), np.nan)
+    filled = np.where(np.isnan(filled), np.repeat(stay_means, lengths, axis=0), filled)
+
+    global_vals = global_means.reindex(mean_df.columns).values.astype(np.float64)
+    filled = np.where(np.isnan(filled), global_vals[None, :], filled)
+
+    # Mask and per-stay time since measured
+    with np.errstate(invalid='ignore'):
+        mask = counts > 0
+    pos = last_observed_positions(mask, offsets)
+    time_since_measured = np.where(
+        pos >= 0, np.arange(n_rows, dtype=np.float64)[:, None] - pos, float(fill_time_since_measured)
+    )
+
+    names = df.columns.names
+    out = []
+    for agg, values in (('mean', filled), ('mask', mask.astype(float)), ('time_since_measured', time_since_measured)):
+        columns = pd.MultiIndex.from_tuples([p + (agg,) for p in prefixes], names=names)
+        out.append(pd.DataFrame(values, index=df.index, columns=columns))
+
+    return pd.concat(out, axis=1).sort_index(axis=1)
+
+PARTITION_PREFIX = 'part_'
+
+def remove_hdf_key(path, key):
+    """ Delete key, and any partitions under it, from the HDF5 store at path if it is there.
+
+    Partitioned writers call this first, so re-running into a key with fewer partitions than before doesn't
+    leave stale higher-numbered partitions behind to be read back with the new ones.
+    """
+    if not os.path.isfile(path): return
+    with pd.HDFStore(path) as store:
+        if key.strip('/') in store: store.remove(key.strip('/'))
+
+def _check_distinct_keys(in_path, in_key, out_path, out_key):
+    # out_key is cleared before writing, which would destroy the input if it is the same key of the same file
+    if os.path.abspath(in_path) == os.path.abspath(out_path) and in_key.strip('/') == out_key.strip('/'):
+        raise ValueError("out_key must differ from in_key when writing to the same file.")
+
+def write_stay_partitions(df, path, key, stays_per_partition=1000):
+    """ Write an hourly frame to an HDF5 store as fixed-format partitions of whole stays, under key/part_*.
+
+    Anything already stored under key is replaced.
+
+    Returns
+    -------
+    n_partitions : int
+    """
+    offsets = stay_offsets(df.index)
+    bounds = offsets[::stays_per_partition]
+    if bounds[-1] != offsets[-1]: bounds = np.append(bounds, offsets[-1])
+
+    remove_hdf_key(path, key)
+    with pd.HDFStore(path) as store:
+        for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            store.put('%s/%s%05d' % (key.strip('/'), PARTITION_PREFIX, i), df.iloc[start:stop])
+    return len(bounds) - 1
+
+def list_stay_partitions(path, key):
+    """ The partition keys under key written by write_stay_partitions, in order ([] if key is a plain frame). """
+    prefix = '/%s/%s' % (key.strip('/'), PARTITION_PREFIX)
+    with pd.HDFStore(path, mode='r') as store:
+        return sorted(k for k in store.keys() if k.startswith(prefix))
+
+def iter_stay_partitions(path, key, stays_per_partition=1000):
+    """ Yield an hourly frame stored in HDF5 one block of whole stays at a time.
+
+    If key holds partitions (see write_stay_partitions), only one partition is in memory at a time. A plain
+    fixed-format frame cannot be read in pieces, so it is loaded once and split.
+    """
+    partitions = list_stay_partitions(path, key)
+    if partitions:
+        for partition in partitions: yield pd.read_hdf(path, partition)
+        return
+
+    df = pd.read_hdf(path, key)
+    offsets = stay_offsets(df.index)
+    bounds = offsets[::stays_per_partition]
+    if bounds[-1] != offsets[-1]: bounds = np.append(bounds, offsets[-1])
+    for start, stop in zip(bounds[:-1], bounds[1:]): yield df.iloc[start:stop]
+
+class SimpleImputer():
+    def __init__(self, fill_time_since_measured=100):
+        """ simple_imputer as a fit / transform object.
+
+        fit stores the per-variable global means of the training subjects; transform imputes any stays with them
+        (see vectorized_simple_imputer), so dev / test / new stays never need the training frame.
+        """
+        self.fill_time_since_measured = fill_time_since_measured
+        self.global_means = None
+        self._sums, self._counts = None, None
+
+    def partial_fit(self, df, train_subj=None):
+        """ Accumulate global mean statistics from df, restricted to train_subj if given. """
+        idx = pd.IndexSlice
+        means = df.loc[:, idx[:, 'mean']]
+        if train_subj is not None:
+            means = means.loc[means.index.get_level_values('subject_id').isin(set(train_subj))]
+
+        sums, counts = means.sum(axis=0), means.count(axis=0)
+        if self._sums is None: self._sums, self._counts = sums, counts
+        else:
+            self._sums = self._sums.add(sums, fill_value=0)
+            self._counts = self._counts.add(counts, fill_value=0)
+
+        self.global_means = self._sums / self._counts.where(self._counts > 0)
+        return self
+
+    def fit(self, df, train_subj=None):
+        self._sums, self._counts = None, None
+        return self.partial_fit(df, train_subj)
+
+    def fit_hdf(self, path, key, train_subj=None):
+        """ fit, streaming the frame at path/key one block of stays at a time. """
+        self._sums, self._counts = None, None
+        for chunk in iter_stay_partitions(path, key): self.partial_fit(chunk, train_subj)
+        return self
+
+    def transform(self, df):
+        assert self.global_means is not None, "Must fit before transform!"
+        return vectorized_simple_imputer(
+            df, global_means=self.global_means, fill_time_since_measured=self.fill_time_since_measured
+        )
+
+    def fit_transform(self, df, train_subj=None):
+        return self.fit(df, train_subj).transform(df)
+
+    def transform_chunks(self, chunks):
+        """ Lazily transform an iterable of frames, each holding whole stays. """
+        for chunk in chunks: yield self.transform(chunk)
+
+    def transform_hdf(self, in_path, in_key, out_path, out_key, stays_per_partition=1000, n_jobs=1):
+        """ Impute the frame at in_path/in_key into stay partitions at out_path/out_key (see iter_stay_partitions).
+
+        With n_jobs > 1, partitions are imputed across a process pool (see parallel_transform_hdf). Anything
+        already stored under out_key is replaced.
+
+        Returns
+        -------
+        n_partitions : int
+        """
+        if n_jobs != 1:
+            return parallel_transform_hdf(self, in_path, in_key, out_path, out_key, stays_per_partition, n_jobs)
+
+        _check_distinct_keys(in_path, in_key, out_path, out_key)
+        remove_hdf_key(out_path, out_key)
+
+        n_partitions = 0
+        for chunk in self.transform_chunks(iter_stay_partitions(in_path, in_key, stays_per_partition)):
+            # Opened per write, so in_path and out_path may be the same file.
+            chunk.to_hdf(out_path, key='%s/%s%05d' % (out_key.strip('/'), PARTITION_PREFIX, n_partitions))
+            n_partitions += 1
+        return n_partitions
+
+    def save(self, path):
+        assert self.global_means is not None, "Must fit before save!"
+        with open(path, mode='w') as f:
+            json.dump({
+                'fill_time_since_measured': self.fill_time_since_measured,
+                'column_names': list(self.global_means.index.names),
+                'columns': [list(c) for c in self.global_means.index],
+                'global_means': [None if np.isnan(v) else float(v) for v in self.global_means.values],
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, mode='r') as f: state = json.load(f)
+        imputer = cls(fill_time_since_measured=state['fill_time_since_measured'])
+        imputer.global_means = pd.Series(
+            [np.nan if v is None else v for v in state['global_means']],
+            index=pd.MultiIndex.from_tuples([tuple(c) for c in state['columns']], names=state['column_names']),
+        )
+        return imputer
+
+_worker_imputer = None
+
+def _init_worker(imputer):
+    global _worker_imputer
+    _worker_imputer = imputer
+
+def _transform_partition(in_path, partition_key, chunk=None):
+    if chunk is None: chunk = pd.read_hdf(in_path, partition_key)
+    return _worker_imputer.transform(chunk)
+
+def parallel_transform_hdf(imputer, in_path, in_key, out_path, out_key, stays_per_partition=1000, n_jobs=None):
+    """ SimpleImputer.transform_hdf over a process pool, one stay partition per task.
+
+    Every worker gets the fitted imputer (and so the shared global means) once, at start up. For a partitioned
+    input (see write_stay_partitions) workers read their own partition, and at most 2 * n_jobs partitions are in
+    flight, so the full frame is never in memory. A plain input frame is read once by the parent and split.
+    Results are written in partition order by the parent, as HDF5 does not support concurrent writers; for the
+    same reason out_path must differ from in_path, which the workers hold open for reading. Anything already
+    stored under out_key is replaced.
+
+    Args
+    ----
+    n_jobs : int or None
+        Number of worker processes; all cores if None.
+
+    Returns
+    -------
+    n_partitions : int
+    """
+    assert imputer.global_means is not None, "Must fit before transform!"
+    if os.path.abspath(in_path) == os.path.abspath(out_path):
+        raise ValueError("parallel_transform_hdf needs out_path to be a different file from in_path.")
+    if n_jobs is None or n_jobs < 1: n_jobs = multiprocessing.cpu_count()
+    remove_hdf_key(out_path, out_key)
+
+    partitions = list_stay_partitions(in_path, in_key)
+    if partitions: tasks = ((in_path, k, None) for k in partitions)
+    else:          tasks = ((in_path, None, c) for c in iter_stay_partitions(in_path, in_key, stays_per_partition))
+
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(imputer,))
+    in_flight, n_partitions = collections.deque(), 0
+    try:
+        for task in tasks:
+            in_flight.append(pool.apply_async(_transform_partition, task))
+            while len(in_flight) >= 2 * n_jobs:
+                in_flight.popleft().get().to_hdf(
+                    out_path, key='%s/%s%05d' % (out_key.strip('/'), PARTITION_PREFIX, n_partitions)
+                )
+                n_partitions += 1
+        while in_flight:
+            in_flight.popleft().get().to_hdf(
+                out_path, key='%s/%s%05d' % (out_key.strip('/'), PARTITION_PREFIX, n_partitions)
+            )
+            n_partitions += 1
+    finally:
+        pool.close()
+        pool.join()
+    return n_partitions